@@ -0,0 +1,379 @@
+"""
+Benchmarks for LabGen. Run as: python benchmark.py <benchmark> [options]; see --help
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import labgen
+
+
+RENDER_TEMPLATES = """
+## row
+++n
+++value
+row %%n: %%value, today is @date
+##
+
+## section \\ Section with nested templates
+++n
+\\section{Section %%n}
+#row||n=%%n|value=a||
+#row||n=%%n|value=b||
+##
+"""
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def generate_render_source(sections):
+    """
+    Document with distinct template invocations (so memoization does not hide expansion cost),
+    plain text containing stray || delimiters and commands
+    """
+    return "".join("#section||%d|| text with a || delimiter and @date\n" % (i,) for i in range(sections))
+
+
+def bench_render(namespace):
+    """
+    Render time for documents of growing size. Time per KB should stay flat
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        lg = labgen.LabGen(tmp, os.path.join(tmp, "fig"), log_level="ERROR")
+        lg.parse_templates(RENDER_TEMPLATES)
+        rates = []
+        print("%10s %10s %12s %10s" % ("sections", "KB", "seconds", "us/KB"))
+        for step in range(namespace.steps):
+            sections = namespace.sections * 2 ** step
+            source = generate_render_source(sections)
+            kb = len(source) / 1024
+
+            def run():
+                lg._expansions.clear()
+                lg.render(source)
+
+            seconds = best_time(run, namespace.repeat)
+            rates.append(seconds / kb)
+            print("%10d %10.1f %12.4f %10.1f" % (sections, kb, seconds, rates[-1] * 1e6))
+        ratio = rates[-1] / rates[0]
+        print("time per KB, largest / smallest document: %.2f" % (ratio,))
+        return 0 if ratio <= namespace.max_ratio else 1
+
+
+STARTUP_PROBE = """
+import json, os, sys, tempfile, time
+start = time.perf_counter()
+import labgen
+imported = time.perf_counter()
+with tempfile.TemporaryDirectory() as tmp:
+    lg = labgen.LabGen(tmp, os.path.join(tmp, "fig"), log_level="ERROR")
+    lg.parse_templates(%r)
+    lg.render("#section||1||")
+first_output = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_output": first_output - start,
+                  "heavy": sorted(m for m in ("matplotlib", "asteval") if m in sys.modules)}))
+"""
+
+
+def bench_startup(namespace):
+    """
+    Import time and time to first output of a document without plots, each in a fresh interpreter
+    """
+    probe = STARTUP_PROBE % (RENDER_TEMPLATES,)
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for _ in range(namespace.repeat):
+        output = subprocess.check_output([sys.executable, "-c", probe], cwd=here)
+        runs.append(json.loads(output.decode()))
+    import_time = min(run["import"] for run in runs)
+    first_output = min(run["first_output"] for run in runs)
+    heavy = runs[0]["heavy"]
+    print("%-30s %10.4f s" % ("import labgen", import_time))
+    print("%-30s %10.4f s" % ("first output (no plots)", first_output))
+    print("%-30s %10s" % ("heavy modules loaded", ", ".join(heavy) or "none"))
+    failed = import_time > namespace.max_import or first_output > namespace.max_first_output or heavy
+    return 1 if failed else 0
+
+
+def generate_corpus(directory, tables=20, rows=1000, cols=4, depth=3, fanout=3, plots=10, curves=2, sections=50,
+                    seed=0):
+    """
+    Writes synthetic headers into <directory>/headers and a source into <directory>/sources.
+    Each section expands a template tree of given depth and fan-out, then shows a table and a plot.
+    Returns (headers dir, sources dir)
+    """
+    rng = random.Random(seed)
+    headers, sources = os.path.join(directory, "headers"), os.path.join(directory, "sources")
+    os.makedirs(headers, exist_ok=True)
+    os.makedirs(sources, exist_ok=True)
+
+    with open(os.path.join(headers, "data.lgd"), "w", encoding="utf-8") as file:
+        for t in range(tables):
+            file.write("^^ table_%d \\ Synthetic table %d\ncols=%s\n^^\n" % (
+                t, t, ";".join("c%d" % (c,) for c in range(cols))))
+            for r in range(rows):
+                file.write(" ".join("%.6g" % (r + rng.random(),) if c == 0 else "%.6g" % (rng.gauss(0, 1),)
+                                    for c in range(cols)))
+                file.write("\n")
+            file.write("\n")
+        for p in range(plots):
+            t = p % max(1, tables)
+            file.write("$$ plot_%d \\ Synthetic plot %d\naxes=x;y\n" % (p, p))
+            for c in range(curves):
+                file.write("curve=curve_%d\n.x=table_%d[0]\n.y=table_%d[%d]*k\n.scope=k = %d\n" % (
+                    c, t, t, 1 + c % max(1, cols - 1), c + 1))
+            file.write("$$\n\n")
+
+    with open(os.path.join(headers, "templates.lgt"), "w", encoding="utf-8") as file:
+        for level in range(depth):
+            file.write("## level_%d\n++n\n" % (level,))
+            if level == depth - 1:
+                file.write("leaf %%n, see @ref||table_0||\n")
+            else:
+                for child in range(fanout):
+                    file.write("#level_%d||n=%%%%n.%d||\n" % (level + 1, child))
+            file.write("##\n\n")
+
+    with open(os.path.join(sources, "report.lgs"), "w", encoding="utf-8") as file:
+        for section in range(sections):
+            file.write("\\section{Section %d}\n" % (section,))
+            if depth:
+                file.write("#level_0||n=%d||\n" % (section,))
+            if tables:
+                file.write("@table||table_%d||\n" % (section % tables,))
+            if plots:
+                file.write("@plot||plot_%d||\n" % (section % plots,))
+    return headers, sources
+
+
+def bench_corpus(namespace):
+    """
+    Writes a synthetic corpus to a directory, e.g. for profiling with labgen.py --profile
+    """
+    headers, sources = generate_corpus(namespace.directory, **corpus_options(namespace))
+    print("headers: %s\nsources: %s" % (headers, sources))
+    return 0
+
+
+def corpus_options(namespace):
+    return {name: getattr(namespace, name)
+            for name in ("tables", "rows", "cols", "depth", "fanout", "plots", "curves", "sections", "seed")}
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per table")
+    parser.add_argument("--cols", type=int, default=4, help="columns per table")
+    parser.add_argument("--depth", type=int, default=3, help="template nesting depth")
+    parser.add_argument("--fanout", type=int, default=3, help="invocations of next level per template")
+    parser.add_argument("--plots", type=int, default=10)
+    parser.add_argument("--curves", type=int, default=2, help="curves per plot")
+    parser.add_argument("--sections", type=int, default=50, help="sections in the document")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def bench_stages(namespace):
+    """
+    Times pipeline stages separately on a synthetic corpus; writes JSON results and checks regression thresholds
+    """
+    options = corpus_options(namespace)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        headers, sources = generate_corpus(os.path.join(tmp, "corpus"), **options)
+        with open(os.path.join(sources, "report.lgs"), encoding="utf-8") as file:
+            source = file.read()
+
+        def new_labgen():
+            return labgen.LabGen(os.path.join(tmp, "out"), os.path.join(tmp, "fig"), log_level="ERROR",
+                                 use_cache=False)
+
+        holder = []
+
+        def process_files():
+            holder[:] = [new_labgen()]
+            holder[0].process_files([headers])
+
+        results["process_files"] = best_time(process_files, namespace.repeat)
+        lg = holder[0]
+
+        # table bodies are parsed lazily, so this is header parsing plus parsing of all table bodies
+        def load_tables():
+            lg.tables.clear()
+            lg.process_files([headers])
+            for name in lg.tables:
+                lg.get_table(name).body
+
+        results["load_tables"] = best_time(load_tables, namespace.repeat)
+
+        def resolve_templates():
+            lg._expansions.clear()
+            holder[:] = [lg.resolve_templates(source)]
+
+        results["resolve_templates"] = best_time(resolve_templates, namespace.repeat)
+        expanded = holder[0]
+
+        def produce_images():
+            for plot in lg.plots.values():
+                plot.figures.clear()
+                plot.produce_image()
+            lg.join_images()
+
+        results["produce_image"] = best_time(produce_images, namespace.plot_repeat) if lg.plots else 0.0
+
+        # plots are drawn already, so this is command dispatch and formatting only
+        results["invoke_commands"] = best_time(lambda: lg.invoke_commands(expanded), namespace.repeat)
+
+        def table_bodies():
+            for name in lg.tables:
+                "".join(labgen.cmd_table_body(lg, name))
+
+        results["cmd_table_body"] = best_time(table_bodies, namespace.repeat)
+        lg.close()
+
+    report = {
+        "config": dict(options, repeat=namespace.repeat),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    print("%-20s %12s" % ("stage", "seconds"))
+    for stage, seconds in results.items():
+        print("%-20s %12.4f" % (stage, seconds))
+    if namespace.json:
+        with open(namespace.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=1)
+
+    limits = {}
+    if namespace.baseline:
+        with open(namespace.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if baseline.get("config") != report["config"]:
+            print("warning: baseline was recorded with other corpus options")
+        limits.update({stage: seconds * namespace.max_slowdown
+                       for stage, seconds in baseline["results"].items()})
+    if namespace.thresholds:
+        with open(namespace.thresholds, encoding="utf-8") as file:
+            limits.update(json.load(file))
+    failed = [stage for stage, limit in limits.items() if stage in results and results[stage] > limit]
+    for stage in failed:
+        print("regression: %s took %.4f s, limit is %.4f s" % (stage, results[stage], limits[stage]))
+    return 1 if failed else 0
+
+
+TABLES_PROBE = """
+import json, os, sys, time, gc
+import labgen
+
+
+def rss():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+with open(sys.argv[1], encoding="utf-8") as file:
+    text = file.read()
+gc.collect()
+before = rss()
+start = time.perf_counter()
+header = labgen.HeaderFile.parse_data(text)
+parsed = time.perf_counter()
+for table in header.tables:
+    table.body
+loaded = time.perf_counter()
+gc.collect()
+print(json.dumps({"tables": len(header.tables), "parse": parsed - start, "load": loaded - parsed,
+                  "rss": rss() - before}))
+"""
+
+
+def generate_small_tables(tables, rows):
+    return "".join("^^ t%d \\ Table %d\ncols=a;b;c\n^^\n%s\n" % (
+        i, i, "".join("%d %d.5 %d\n" % (r, r, i) for r in range(rows))) for i in range(tables))
+
+
+def bench_tables(namespace):
+    """
+    Parse time, table load time and memory (RSS growth) of many small tables, per 10k tables
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "tables.lgd")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(generate_small_tables(namespace.tables, namespace.rows))
+        runs = []
+        for _ in range(namespace.repeat):
+            output = subprocess.check_output([sys.executable, "-c", TABLES_PROBE, path], cwd=here)
+            runs.append(json.loads(output.decode()))
+    scale = 10000 / namespace.tables
+    parse_time = min(run["parse"] for run in runs) * scale
+    load_time = min(run["load"] for run in runs) * scale
+    rss = min(run["rss"] for run in runs) * scale
+    print("%-30s %10.3f s" % ("parse per 10k tables", parse_time))
+    print("%-30s %10.3f s" % ("load bodies per 10k tables", load_time))
+    print("%-30s %10.1f MiB" % ("RSS per 10k tables", rss / 2 ** 20))
+    return 1 if parse_time > namespace.max_parse or rss / 2 ** 20 > namespace.max_rss else 0
+
+
+def prepare_args_parser():
+    parser = argparse.ArgumentParser(description="LabGen benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    render = subparsers.add_parser("render", help=bench_render.__doc__.strip())
+    render.add_argument("--sections", type=int, default=250, help="sections in the smallest document")
+    render.add_argument("--steps", type=int, default=5, help="count of doublings of document size")
+    render.add_argument("--repeat", type=int, default=3)
+    render.add_argument("--max-ratio", type=float, default=2.0,
+                        help="fail if time per KB grows more than this between smallest and largest document")
+    render.set_defaults(func=bench_render)
+
+    startup = subparsers.add_parser("startup", help=bench_startup.__doc__.strip())
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.add_argument("--max-import", type=float, default=0.25, help="fail if importing labgen takes longer")
+    startup.add_argument("--max-first-output", type=float, default=0.35,
+                         help="fail if rendering the first document takes longer, import included")
+    startup.set_defaults(func=bench_startup)
+
+    tables = subparsers.add_parser("tables", help=bench_tables.__doc__.strip())
+    tables.add_argument("--tables", type=int, default=10000)
+    tables.add_argument("--rows", type=int, default=3, help="rows per table")
+    tables.add_argument("--repeat", type=int, default=3)
+    tables.add_argument("--max-parse", type=float, default=1.0, help="fail if parse per 10k tables takes longer, s")
+    tables.add_argument("--max-rss", type=float, default=64.0, help="fail if RSS per 10k tables grows more, MiB")
+    tables.set_defaults(func=bench_tables)
+
+    corpus = subparsers.add_parser("corpus", help=bench_corpus.__doc__.strip())
+    corpus.add_argument("directory")
+    add_corpus_arguments(corpus)
+    corpus.set_defaults(func=bench_corpus)
+
+    stages = subparsers.add_parser("stages", help=bench_stages.__doc__.strip())
+    add_corpus_arguments(stages)
+    stages.add_argument("--repeat", type=int, default=3)
+    stages.add_argument("--plot-repeat", type=int, default=1, help="repeats of plot drawing, which is slow")
+    stages.add_argument("--json", help="write results to this file")
+    stages.add_argument("--baseline", help="results file of an earlier run to compare with")
+    stages.add_argument("--max-slowdown", type=float, default=1.25,
+                        help="fail if a stage is slower than in baseline by more than this factor")
+    stages.add_argument("--thresholds", help="JSON file with max seconds per stage")
+    stages.set_defaults(func=bench_stages)
+    return parser
+
+
+if __name__ == '__main__':
+    args = prepare_args_parser().parse_args(sys.argv[1:])
+    sys.exit(args.func(args))
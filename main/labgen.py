@@ -1,14 +1,21 @@
 import numpy as np
-import asteval
 import re
 import time
-import random
 import os
 import sys
 import argparse
 import logging
-
-from matplotlib import pyplot as pp
+import concurrent.futures
+import hashlib
+import shutil
+import filecmp
+import itertools
+import contextlib
+import pickle
+import json
+import io
+import multiprocessing
+import fnmatch
 
 
 def create_variable_pattern(initiating_char, closing_char):
@@ -22,6 +29,14 @@ def find_all_properties(clazz: type, prefix="_PROP_"):
             for field_name in dir(clazz) if field_name.startswith(prefix)}
 
 
+def slots_state(obj):
+    """
+    Returns dict of assigned slots of obj, for __getstate__ of classes with __slots__
+    """
+    return {name: getattr(obj, name) for cls in type(obj).__mro__ for name in getattr(cls, "__slots__", ())
+            if hasattr(obj, name)}
+
+
 def get_method_arg_names(method):
     return method.__code__.co_varnames[:method.__code__.co_argcount]
 
@@ -43,13 +58,16 @@ def remove_non_alphanum(string):
     return "".join(filter(lambda ch: ch.isalnum() or ch == "_", string))
 
 
-def random_str(length):
-    gen = hex(random.getrandbits(length * 4))[2:]
-    return ("0" * (length - len(gen))) + gen
-
-
-def generate_label(name: str):
-    return "label_" + remove_non_alphanum(name) + "_" + random_str(4)
+def generate_label(name: str, kind: str = ""):
+    """
+    Returns the same label for the same name on every run, so unchanged documents stay byte-identical.
+    If cleaning changed the name, short hash of the original is appended, so that e.g. "a-b" and "ab" differ
+    """
+    clean = remove_non_alphanum(name)
+    label = "label_" + (kind + "_" if kind else "") + clean
+    if clean != name:
+        label += "_" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:6]
+    return label
 
 
 def flatten_2d_np_array(array, lowest_level_types=(np.array, np.ndarray)):
@@ -70,8 +88,30 @@ def split_ext(path):
 
 
 def list_files(dir_path):
-    return [dir_path + os.sep + filename for filename in
-            filter(lambda s: not os.path.isdir(dir_path + os.sep + s), os.listdir(dir_path))]
+    return sorted(entry.path for entry in os.scandir(dir_path) if not entry.is_dir())
+
+
+def write_if_changed(path, data):
+    """
+    Writes bytes through a temporary file and rename. File which has these bytes already is left alone
+    (along with its mtime); returns False in that case
+    """
+    try:
+        if os.path.getsize(path) == len(data):
+            with open(path, "rb") as file:
+                if file.read() == data:
+                    return False
+    except OSError:
+        pass
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
 
 
 def read_file(filename, encoding):
@@ -79,7 +119,72 @@ def read_file(filename, encoding):
         return file.read()
 
 
-def do_for_path(path, action, recursive=False, encoding="utf-8"):
+def matches_any(path, patterns):
+    """
+    Checks path and its base name against glob patterns
+    """
+    name = os.path.basename(path)
+    return any(fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+
+def scan_files(path, recursive=False, extensions=None, include=(), exclude=()):
+    """
+    Lists files in path with their sizes and mtimes, filtered by name before anything is opened.
+    Directory entries are read with os.scandir, so only matching files are stat'ed.
+    Returns sorted list of (path, size, mtime_ns); missing path gives an empty list
+
+    :param path: file or directory
+    :param recursive: note: if this set to False, and path is directory, files from directory will still be resolved
+    :param extensions: extensions (without dot) of files to keep, or None for all
+    :param include: glob patterns; if any are given, files must match one of them
+    :param exclude: glob patterns of files and directories to skip
+    """
+    def accepted(file_path):
+        return (extensions is None or split_ext(file_path)[1] in extensions) and \
+            (not include or matches_any(file_path, include)) and not matches_any(file_path, exclude)
+
+    path = os.path.normpath(path)
+    res = []
+    try:
+        if not os.path.isdir(path):
+            if accepted(path):
+                st = os.stat(path)
+                res.append((path, st.st_size, st.st_mtime_ns))
+            return res
+    except OSError:
+        return res
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir():
+                if recursive and not matches_any(entry.path, exclude):
+                    directories.append(entry.path)
+            elif accepted(entry.path):
+                try:
+                    st = entry.stat()
+                except OSError:  # removed meanwhile
+                    continue
+                res.append((entry.path, st.st_size, st.st_mtime_ns))
+    res.sort()
+    return res
+
+
+def collect_files(path, recursive=False, extensions=None, include=(), exclude=()):
+    """
+    Lists files in path; see scan_files
+
+    :param path: file or directory
+    :param recursive: note: if this set to False, and path is directory, files from directory will still be resolved
+    """
+    return [file_path for file_path, _, _ in scan_files(path, recursive, extensions, include, exclude)]
+
+
+def do_for_path(path, action, recursive=False, encoding="utf-8", extensions=None):
     """
     Perform a particular action on each file and/or directory in path
 
@@ -87,14 +192,50 @@ def do_for_path(path, action, recursive=False, encoding="utf-8"):
     :param action: callable. receives path as the first parameter, file contents as second
     :param recursive: note: if this set to False, and path is directory, files from directory will still be resolved
     :param encoding: encoding for file opening
+    :param extensions: extensions of files to read; others are not opened
     """
-    path = os.path.normpath(path)
-    if os.path.isdir(path):
-        for p in (list_files(path) if not recursive else os.listdir(path)):
-            do_for_path(p, action, recursive=recursive, encoding=encoding)
-    else:
-        filename, ext = split_ext(path)
-        action(filename, ext, read_file(path, encoding))
+    for file_path in collect_files(path, recursive=recursive, extensions=extensions):
+        filename, ext = split_ext(file_path)
+        action(filename, ext, read_file(file_path, encoding))
+
+
+# matplotlib and asteval take a while to import and are not needed for documents without plots,
+# so they are imported on first use
+
+PLOT_BACKEND = "Agg"
+
+
+def import_figure_class():
+    """
+    Returns matplotlib Figure class. Backend is set explicitly and pyplot is never imported
+    (matplotlib.get_backend would import it and resolve the default backend), so no GUI toolkit is ever touched
+    """
+    import matplotlib
+    matplotlib.use(PLOT_BACKEND)
+    from matplotlib.figure import Figure
+    return Figure
+
+
+def create_figure():
+    """
+    Returns matplotlib Figure attached to a non-GUI canvas
+    """
+    figure = import_figure_class()()
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def create_interpreter():
+    import asteval
+    return asteval.Interpreter()
+
+
+def find_identifiers(string):
+    return set(IDENTIFIER_PATTERN.findall(string or ""))
+
+
+IDENTIFIER_PATTERN = re.compile(r"[^\W\d]\w*", re.U)
 
 
 class LabGenError(Exception):
@@ -102,7 +243,89 @@ class LabGenError(Exception):
         super().__init__(message)
 
 
+def topological_order(roots, dependencies):
+    """
+    Returns roots and everything they (transitively) depend on, dependencies first
+
+    :param dependencies: callable which returns names the given name depends on
+    """
+    order, state = [], {}
+    visiting, done = 1, 2
+
+    def visit(name, path):
+        if state.get(name) == done:
+            return
+        if state.get(name) == visiting:
+            raise LabGenError("dependency cycle: " + " -> ".join(path[path.index(name):] + [name]))
+        state[name] = visiting
+        for dependency in dependencies(name):
+            visit(dependency, path + [name])
+        state[name] = done
+        order.append(name)
+
+    for root in roots:
+        visit(root, [])
+    return order
+
+
+class TextSlice:
+    """
+    Stripped substring which references the whole text instead of copying it
+    """
+    __slots__ = ("text", "start", "end")
+
+    def __init__(self, text, start, end):
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        self.text, self.start, self.end = text, start, end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return self.text[self.start:self.end]
+
+
+class DependencyGraph:
+    """
+    Tracks which header file defines which entities and which source file uses which entities.
+    Entities are (kind, name) pairs, where kind is one of LabGen.KIND_* constants
+    """
+
+    def __init__(self):
+        # header path -> {entity: hash of its definition or None}
+        self.definitions = {}
+        self.defined_by = {}
+        self.usages = {}
+
+    def set_definitions(self, header_path, entities):
+        """
+        :param entities: dict entity -> hash of its definition, or None if it is unknown
+        """
+        self.pop_definitions(header_path)
+        self.definitions[header_path] = dict(entities)
+        for entity in entities:
+            self.defined_by[entity] = header_path
+
+    def pop_definitions(self, header_path):
+        entities = self.definitions.pop(header_path, {})
+        for entity in entities:
+            self.defined_by.pop(entity, None)
+        return entities
+
+    def set_usages(self, source_path, entities):
+        self.usages[source_path] = set(entities)
+
+    def affected_sources(self, entities):
+        entities = set(entities)
+        return sorted(path for path, used in self.usages.items() if used & entities)
+
+
 class RangeObject:
+    __slots__ = ("start", "stop", "auto_scale")
+
     def __init__(self, start_stop: str):
         self.start, self.stop = None, None
         self.auto_scale = start_stop.strip() == "autoscale"
@@ -117,6 +340,8 @@ class RangeObject:
 
 
 class Property:
+    __slots__ = ("default", "type", "object_type", "name", "single_value")
+
     def __init__(self, name, type_, object_type=None, default=None, single_value=True):
         self.default = default
         self.type = type_
@@ -129,10 +354,61 @@ class Property:
             self.name, self.type, self.default, str(self.object_type), self.single_value)
 
 
+class PropertySchema:
+    """
+    Properties of a class with their defaults already converted, so building metadata of an instance
+    only has to fill in missing values
+    """
+    __slots__ = ("properties", "defaults", "required")
+
+    def __init__(self, properties: dict, converters: dict):
+        self.properties = properties
+        self.defaults = {}
+        self.required = []
+        for prop in properties.values():
+            if prop.type == PropertyHolder.METADATA_VALUE_TYPE_BUILDER:
+                continue
+            if prop.default is None:
+                self.required.append(prop.name)
+                continue
+            converter = converters.get(prop.type, None)
+            if converter is None:
+                raise LabGenError("Converter for type %s not found" % (prop.type,))
+            self.defaults[prop.name] = converter(prop.default.strip())
+
+
+class PropertyHolder:
+    """
+    Base of classes described by _PROP_ attributes. Schema of each subclass is compiled once, when it is created
+    """
+    __slots__ = ()
+
+    METADATA_VALUE_TYPE_NUMBER = "number"
+    METADATA_VALUE_TYPE_LIST = "list"
+    METADATA_VALUE_TYPE_BUILDER = "builder"
+    METADATA_VALUE_TYPE_STR = "str"
+    METADATA_VALUE_TYPE_RANGE = "range"
+    METADATA_VALUE_TYPE_BOOL = "boolean"
+
+    CONVERTERS = {
+        METADATA_VALUE_TYPE_LIST: lambda s: [k.strip() for k in filter(bool, s.split(";"))],
+        METADATA_VALUE_TYPE_NUMBER: lambda s: float(s),
+        METADATA_VALUE_TYPE_STR: lambda s: s.strip(),
+        METADATA_VALUE_TYPE_RANGE: RangeObject,
+        METADATA_VALUE_TYPE_BOOL: lambda s: s is not None and s.lower() not in ["false", "f", "0"]
+    }
+
+    SCHEMA = PropertySchema({}, CONVERTERS)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.SCHEMA = PropertySchema(find_all_properties(cls), cls.CONVERTERS)
+
+
 # noinspection PyCallingNonCallable
 class Builder:
-    def __init__(self, possible_properties: dict, converters: dict):
-        self.possible_properties = possible_properties
+    def __init__(self, schema: PropertySchema, converters: dict):
+        self.schema = schema
         self.converters = converters
         self.metadata = {}
         self.object_builder = None
@@ -158,7 +434,7 @@ class Builder:
         self.object_builder = None
 
     def put(self, key: str, value: str):
-        prop = self.possible_properties[key]
+        prop = self.schema.properties[key]
         if prop.type == DatafileVariable.METADATA_VALUE_TYPE_BUILDER:
             self.flush_object_builder()
             self.object_builder = ObjectBuilder(self.process_value(DatafileVariable.METADATA_VALUE_TYPE_STR, value),
@@ -175,18 +451,19 @@ class Builder:
         # fill in default values
         if self.object_builder:
             self.flush_object_builder()
-        for prop in self.possible_properties.values():
-            if not (prop.name in self.metadata.keys()) \
-                    and prop.type != DatafileVariable.METADATA_VALUE_TYPE_BUILDER:
-                if prop.default is None:
-                    raise LabGenError("Value is not presented for required property %s" % (prop.name,))
-                self.put(prop.name, prop.default)
+        for name in self.schema.required:
+            if name not in self.metadata:
+                raise LabGenError("Value is not presented for required property %s" % (name,))
+        for name, default in self.schema.defaults.items():
+            if name not in self.metadata:
+                # lists are the only mutable defaults
+                self.metadata[name] = list(default) if type(default) is list else default
         return self.metadata
 
 
 class ObjectBuilder(Builder):
     def __init__(self, object_name: str, builder_property: Property, converters: dict):
-        super().__init__(find_all_properties(builder_property.object_type), converters)
+        super().__init__(builder_property.object_type.SCHEMA, converters)
         self.obj_name = object_name
         self.property = builder_property
 
@@ -194,36 +471,24 @@ class ObjectBuilder(Builder):
         return self.property.object_type(self.obj_name, super().build())
 
 
-class DatafileVariable:
-    METADATA_VALUE_TYPE_NUMBER = "number"
-    METADATA_VALUE_TYPE_LIST = "list"
-    METADATA_VALUE_TYPE_BUILDER = "builder"
-    METADATA_VALUE_TYPE_STR = "str"
-    METADATA_VALUE_TYPE_RANGE = "range"
-    METADATA_VALUE_TYPE_BOOL = "boolean"
+class DatafileVariable(PropertyHolder):
+    __slots__ = ("name", "human_readable_name", "metadata", "label")
 
-    CONVERTERS = {
-        METADATA_VALUE_TYPE_LIST: lambda s: [k.strip() for k in filter(bool, s.split(";"))],
-        METADATA_VALUE_TYPE_NUMBER: lambda s: float(s),
-        METADATA_VALUE_TYPE_STR: lambda s: s.strip(),
-        METADATA_VALUE_TYPE_RANGE: RangeObject,
-        METADATA_VALUE_TYPE_BOOL: lambda s: s is not None and s.lower() not in ["false", "f", "0"]
-    }
+    LABEL_KIND = "variable"
 
     METADATA_PATTERN = \
         re.compile(r"^(?P<dot_prefix>\.?)(?P<key>\w+)\s*=(?:$|\s*(?P<value>.*))",
                    re.M | re.U)
 
-    def __init__(self, name, human_readable_name, metadata, properties):
+    def __init__(self, name, human_readable_name, metadata):
         self.name = name
         self.human_readable_name = human_readable_name
-        self.properties = properties
         self.metadata = None
         self.parse_metadata(metadata)
-        self.label = generate_label(self.name)
+        self.label = generate_label(self.name, self.LABEL_KIND)
 
     def parse_metadata(self, string):
-        builder, last_were_object = Builder(self.properties, DatafileVariable.CONVERTERS), False
+        builder, last_were_object = Builder(self.SCHEMA, self.CONVERTERS), False
         for match in DatafileVariable.METADATA_PATTERN.finditer(string):
             is_building_object_property, key, value = bool(match.group("dot_prefix")), \
                                                       match.group("key"), \
@@ -243,9 +508,18 @@ class DatafileVariable:
 
 
 class Table(DatafileVariable):
+    __slots__ = ("body_cache", "table_pool", "raw_body", "source_path", "spill_path", "_body", "cols")
+
+    LABEL_KIND = "table"
+
     _PROP_COLS = Property("cols", DatafileVariable.METADATA_VALUE_TYPE_LIST, default="")
     _PROP_META = Property("meta", DatafileVariable.METADATA_VALUE_TYPE_BOOL, default="0")
     _PROP_STACK = Property("stack", DatafileVariable.METADATA_VALUE_TYPE_LIST, default="")
+    _PROP_SOURCE = Property("source", DatafileVariable.METADATA_VALUE_TYPE_STR, default="")
+    _PROP_SOURCE_COLS = Property("source_cols", DatafileVariable.METADATA_VALUE_TYPE_LIST, default="")
+    _PROP_SOURCE_KEY = Property("source_key", DatafileVariable.METADATA_VALUE_TYPE_STR, default="")
+
+    SOURCE_FORMATS = ["npy", "npz", "csv", "tsv", "txt", "dat"]
 
     DEFINITION_PATTERN = re.compile(
         r"\^{2}\s*(?P<name>\w*)\s*(\\)?\s*(?(2)(?P<caption>[^\n\r]*))"
@@ -253,20 +527,161 @@ class Table(DatafileVariable):
         re.S)
     META_STACK_COLS_PATTERN = re.compile(r"(?P<col_number>\d+)\s*,?")
 
-    def __init__(self, name, human_readable_name, metadata, body):
-        super().__init__(name, human_readable_name, metadata, find_all_properties(Table))
-        self.body = self.parse_table_body(body) if body else np.empty((0,))
+    def __init__(self, name, human_readable_name, metadata, body, body_cache=None, base_dir=None, table_pool=None):
+        """
+        Only metadata is parsed here; body is parsed (or loaded, or stacked) on first access
+
+        :param body: table text: str or TextSlice
+        :param table_pool: tables available for stacking into this one, if it is a meta table
+        """
+        super().__init__(name, human_readable_name, metadata)
+        self.body_cache = body_cache
+        self.table_pool = table_pool
+        self.raw_body = body
+        self.source_path = self.metadata[Table._PROP_SOURCE.name]
+        if self.source_path:
+            self.source_path = os.path.normpath(os.path.join(base_dir or "", self.source_path))
+            if split_ext(self.source_path)[1].lower() not in Table.SOURCE_FORMATS:
+                raise LabGenError("unsupported data source for table %s: %s; possible formats are %s" % (
+                    self.name, self.source_path, Table.SOURCE_FORMATS))
+        # body cache file which body of inline table was unloaded to, see unload
+        self.spill_path = None
+        self._body = None
         self.cols = []
 
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = self.materialize()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        if value is None:
+            self.cols = []
+
+    @property
+    def materialized(self):
+        return self._body is not None
+
+    def reloadable(self):
+        """
+        Checks if body can be materialized again once dropped; text of inline tables is not kept after parsing,
+        so they are reloadable only once spilled to body cache (see unload)
+        """
+        return bool(self.source_path) or self.metadata.get(Table._PROP_META.name, False) or \
+            self.spill_path is not None
+
+    def body_size(self):
+        """
+        Returns bytes held by body in memory. Memory mapped bodies and stacked columns of other tables are not counted
+        """
+        if self._body is None or isinstance(self._body, (np.memmap, ColumnStack)):
+            return 0
+        return getattr(self._body, "nbytes", 0)
+
+    def unload(self):
+        """
+        Drops body if it can be materialized again. Body of inline table is spilled to body cache first,
+        to be loaded back memory-mapped. Returns count of released bytes
+        """
+        if self._body is None:
+            return 0
+        if not self.reloadable():
+            if self.body_cache is None or not self.body_size():
+                return 0
+            self.spill_path = self.body_cache.spill(self._body)
+        size = self.body_size()
+        self.body = None
+        return size
+
+    def materialize(self):
+        if self.source_path:
+            return self.load_source()
+        if self.metadata.get(Table._PROP_META.name, False):
+            self.process_meta_properties(self.table_pool or {})
+            return self._body
+        if self.spill_path is not None:
+            try:
+                return np.load(self.spill_path, mmap_mode="r")
+            except (OSError, ValueError) as e:
+                raise LabGenError("unloaded body of table %s is lost: %s" % (self.name, e))
+        # raw text is not needed anymore
+        body, self.raw_body = self.raw_body, None
+        return self.parse_table_body(str(body), self.body_cache) if body else np.empty((0,))
+
+    def get_cols(self):
+        """
+        Returns declared column names or, if there are none, names inferred when body was loaded
+        (header of data file, stacked columns or constants)
+        """
+        self.body
+        return self.metadata[Table._PROP_COLS.name] or self.cols
+
+    def load_source(self):
+        """
+        Loads data from external file. .npy files are memory-mapped, text files are read in chunks
+        """
+        path, ext = self.source_path, split_ext(self.source_path)[1].lower()
+        if not os.path.exists(path):
+            raise LabGenError("data source of table %s does not exist: %s" % (self.name, path))
+        names = None
+        if ext == "npy":
+            rows = np.load(path, mmap_mode="r")
+        elif ext == "npz":
+            with np.load(path) as archive:
+                rows = archive[self.metadata[Table._PROP_SOURCE_KEY.name] or archive.files[0]]
+        else:
+            rows, names = load_text_table(path, "," if ext == "csv" else None, self.body_cache)
+        if rows.ndim == 1:
+            rows = rows.reshape((-1, 1))
+        selection = self.metadata[Table._PROP_SOURCE_COLS.name]
+        if selection:
+            indices = []
+            for col in selection:
+                if names and col in names:
+                    indices.append(names.index(col))
+                elif col.lstrip("-").isdigit() and -rows.shape[1] <= int(col) < rows.shape[1]:
+                    indices.append(int(col) % rows.shape[1])
+                else:
+                    raise LabGenError("table %s selects unknown column %s of %s; available columns are %s" % (
+                        self.name, col, path, names or list(range(rows.shape[1]))))
+            if indices == list(range(indices[0], indices[0] + len(indices))):
+                # keep memory-mapped data a view
+                rows = rows[:, indices[0]:indices[0] + len(indices)]
+            else:
+                rows = rows[:, indices]
+            names = [names[i] for i in indices] if names else [str(i) for i in indices]
+        self.cols = names or [str(i) for i in range(rows.shape[1])]
+        return rows.transpose()
+
+    def stacked_tables(self):
+        """
+        Returns names of tables this meta table is built from
+        """
+        if not self.metadata.get(Table._PROP_META.name, False):
+            return []
+        return [entry.split(None, 1)[0] for entry in self.metadata.get(Table._PROP_STACK.name, [])]
+
     def process_meta_properties(self, table_pool):
         if not self.metadata.get(Table._PROP_META.name, False):
             # this is not a metatable:
             return
-        final_columns = []
+
+        def dependencies(name):
+            if name not in table_pool:
+                raise LabGenError("meta table %s stacks unknown table %s" % (self.name, name))
+            return table_pool[name].stacked_tables() if name != self.name else self.stacked_tables()
+
+        # stacked meta tables have to be resolved first
+        for name in topological_order([self.name], dependencies)[:-1]:
+            table_pool[name].get_cols()
+        self.cols, final_columns = [], []
         for entry in self.metadata.get(Table._PROP_STACK.name, []):
-            e = re.compile("\s*").split(entry, maxsplit=1)
+            e = entry.split(None, 1)
             t = table_pool[e[0]]
-            foreign_cols = t.metadata[Table._PROP_COLS.name]
+            foreign_cols = t.get_cols()
             if len(e) > 1:
                 for i in map(lambda m: int(m.group("col_number")), Table.META_STACK_COLS_PATTERN.finditer(e[1])):
                     self.cols.append(foreign_cols[i])
@@ -274,24 +689,407 @@ class Table(DatafileVariable):
             else:
                 # take all cols:
                 self.cols.extend(foreign_cols)
-                final_columns.append(t.body)
-        self.body = np.vstack(final_columns)
+                final_columns.extend(t.body)
+        self.body = ColumnStack(final_columns, self.name)
 
-    def parse_table_body(self, body):
+    def parse_table_body(self, body, body_cache=None):
+        cols_count = len(self.metadata[Table._PROP_COLS.name])
+        if body_cache is not None and len(body) >= body_cache.min_size:
+            rows = body_cache.load(body, cols_count)
+        else:
+            rows = parse_table_text(body, cols_count)
         # transpose here is used to provide convenient usage in plot ASTEVAL exprs
-        return np.reshape(np.fromstring(body, dtype=np.float, sep=" "),
-                          (body.count("\n") + 1, len(self.metadata["cols"]))).transpose()
+        return rows.transpose()
 
     def body_as_one_line_string(self):
         return "[" + ", ".join(["[" + " ".join(map(str, arr)) + "]" for arr in self.body]) + "]"
 
     def __str__(self):
         return "Table<%s; body=\"%s\">" % (
-            super().__str__(), self.body_as_one_line_string()
+            super().__str__(),
+            self.body_as_one_line_string() if self._body is not None else "<%s>" % (
+                self.source_path or "not parsed",)
         )
 
+    def __getstate__(self):
+        # pool and cache belong to LabGen instance; bodies which can be loaded again are not stored
+        state = slots_state(self)
+        state["table_pool"], state["body_cache"] = None, None
+        if self.reloadable() or isinstance(self._body, np.memmap):
+            state["_body"], state["cols"] = None, []
+        return None, state
+
+
+class ColumnStack(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Body of a meta table: 2D array-like made of references to columns of other tables.
+    Indexing by column and iteration return the original columns; data is copied only when a real array is needed
+    (arithmetic, np.asarray, transpose, ndarray methods and attributes like sum or size)
+    """
+
+    def __init__(self, columns, name=None):
+        columns = [np.asarray(column) for column in columns]
+        if len({len(column) for column in columns}) > 1:
+            raise LabGenError("can't stack columns of different lengths %s into table %s" % (
+                [len(column) for column in columns], name))
+        self.columns = columns
+
+    @property
+    def shape(self):
+        return len(self.columns), (len(self.columns[0]) if self.columns else 0)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return np.result_type(*self.columns) if self.columns else np.dtype(np.float64)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.columns[key]
+        if isinstance(key, slice):
+            return ColumnStack(self.columns[key])
+        if isinstance(key, tuple) and key and isinstance(key[0], (int, np.integer)):
+            return self.columns[key[0]][key[1:]]
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        stacked = np.vstack(self.columns) if self.columns else np.empty((0, 0))
+        return stacked if dtype is None else stacked.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        inputs = [np.asarray(i) if isinstance(i, ColumnStack) else i for i in inputs]
+        return getattr(ufunc, method)(*inputs, **kwargs)
+
+    def transpose(self):
+        return np.asarray(self).transpose()
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def __getattr__(self, name):
+        # only called for attributes not defined here; special ones are not delegated, so copy and pickle work
+        if name.startswith("__") or name == "columns":
+            raise AttributeError(name)
+        return getattr(np.asarray(self), name)
+
+    def __repr__(self):
+        return "ColumnStack(%s)" % (self.columns,)
+
+
+TABLE_COMMENT_CHAR = "#"
+TABLE_MISSING_VALUES = ["-", "?", "NA", "N/A", "na", "n/a", "nan", "NaN"]
+
+
+class DerivedTable(Table):
+    """
+    Block of constants, each defined by an expression over tables and other constants:
+
+        ~~ name \\ caption
+        speed = t[1] / t[0]
+        error = 0.05 * speed
+        ~~
+
+    Constants are evaluated once per data version (see LabGen.constant_values) and are available to plot
+    expressions by their names. The block itself is a table of its array constants, so it can be tabulated
+    and used in plots by block name
+    """
+    __slots__ = ("expressions", "labgen_instance", "_version")
+
+    DEFINITION = "~{2}"
+    DEFINITION_PATTERN = create_variable_pattern(DEFINITION, DEFINITION)
+    CONSTANT_PATTERN = re.compile(r"^\s*(?P<name>[^\W\d]\w*)\s*=(?!=)(?P<expression>.+)$", re.U)
+
+    def __init__(self, name, human_readable_name, definitions, labgen_instance=None):
+        """
+        :param definitions: text with one "name = expression" per line; empty lines and lines starting
+            with TABLE_COMMENT_CHAR are skipped
+        """
+        super().__init__(name, human_readable_name, "", "")
+        self.labgen_instance = labgen_instance
+        self._version = None
+        # constant name -> expression, in order of definition
+        self.expressions = {}
+        for line in definitions.splitlines():
+            if not line.strip() or line.lstrip().startswith(TABLE_COMMENT_CHAR):
+                continue
+            match = DerivedTable.CONSTANT_PATTERN.match(line)
+            if match is None:
+                raise LabGenError("invalid constant definition in %s: %s" % (self.name, line.strip()))
+            constant = match.group("name")
+            if constant in self.expressions:
+                raise LabGenError("constant %s is defined twice in %s" % (constant, self.name))
+            self.expressions[constant] = match.group("expression").strip()
+        if self.name in self.expressions:
+            raise LabGenError("constant %s has the same name as its block" % (self.name,))
+
+    @property
+    def body(self):
+        if self._body is None or self._version != self.labgen_instance.data_version:
+            self._body = self.materialize()
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        if value is None:
+            self.cols = []
+
+    def materialize(self):
+        """
+        Stacks array constants of this block. They must be one-dimensional and of the same length
+        """
+        labgen = self.labgen_instance
+        version = labgen.data_version
+        values = labgen.constant_values(list(self.expressions))
+        cols = [name for name, value in values.items() if np.ndim(value) == 1]
+        lengths = {len(values[name]) for name in cols}
+        if len(lengths) > 1:
+            raise LabGenError("columns of %s have different lengths: %s" % (
+                self.name, ", ".join("%s=%d" % (name, len(values[name])) for name in cols)))
+        self.cols = cols
+        self._version = version
+        return np.vstack([values[name] for name in cols]) if cols else np.empty((0,))
+
+    def reloadable(self):
+        return True
+
+    def __getstate__(self):
+        _, state = super().__getstate__()
+        state["labgen_instance"], state["_version"] = None, None
+        return None, state
+
+
+# ASCII characters which str.splitlines treats as line breaks
+ASCII_LINE_BREAKS = np.zeros(256, dtype=bool)
+ASCII_LINE_BREAKS[list(b"\n\v\f\r\x1c\x1d\x1e")] = True
+# shorter tables are parsed faster line by line
+UNIFORM_TABLE_MIN_SIZE = 2 ** 10
+
+
+def parse_uniform_table_text(text, cols_count=0):
+    """
+    Fast path of parse_table_text for whitespace-separated ASCII tables where every non-blank line has
+    the same count of numbers: all tokens are converted at once. Returns None for any other table
+    """
+    if not text.isascii():
+        return None
+    data = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    # all ASCII whitespace is below 33; other control characters split tokens here, but not in str.split,
+    # which makes the token count check below fail
+    space = data <= 32
+    token_starts = ~space
+    token_starts[1:] &= space[:-1]
+    token_starts = np.flatnonzero(token_starts)
+    space = np.flatnonzero(space)
+    breaks = space[ASCII_LINE_BREAKS[data[space]]]
+    # tokens of each line; blank lines (including the ones between \r and \n) have none
+    counts = np.diff(np.searchsorted(token_starts, breaks), prepend=0, append=len(token_starts))
+    counts = counts[counts > 0]
+    if not len(counts):
+        return np.empty((0, cols_count))
+    cols_count = cols_count or int(counts[0])
+    if (counts != cols_count).any():
+        return None
+    try:
+        values = np.array(text.split(), dtype=np.float64)
+    except ValueError:
+        return None  # e.g. missing values
+    return values.reshape((len(counts), cols_count)) if len(values) == len(counts) * cols_count else None
+
+
+def parse_table_text(text, cols_count=0, delimiter=None):
+    """
+    Parses whitespace-separated table into rows x cols float array.
+    Everything after TABLE_COMMENT_CHAR on a line is ignored, as well as blank lines.
+    Missing cells (TABLE_MISSING_VALUES, empty cells or short rows) become NaN
+
+    :param cols_count: expected count of columns; if 0, it is taken from the longest row
+    :param delimiter: cell delimiter, any whitespace by default
+    """
+    if delimiter is None and len(text) >= UNIFORM_TABLE_MIN_SIZE and TABLE_COMMENT_CHAR not in text:
+        values = parse_uniform_table_text(text, cols_count)
+        if values is not None:
+            return values
+    if TABLE_COMMENT_CHAR in text:
+        text = "\n".join(line.split(TABLE_COMMENT_CHAR, 1)[0] for line in text.splitlines())
+    if delimiter is None:
+        rows = [row for row in map(str.split, text.splitlines()) if row]
+    else:
+        rows = [[cell.strip() for cell in line.split(delimiter)] for line in text.splitlines() if line.strip()]
+    if not rows:
+        return np.empty((0, cols_count))
+    lengths = np.fromiter(map(len, rows), dtype=np.intp, count=len(rows))
+    cols_count = cols_count or int(lengths.max())
+    if lengths.max() > cols_count:
+        raise LabGenError("table row %d has %d values, but there are only %d columns" % (
+            int(np.argmax(lengths > cols_count)) + 1, int(lengths.max()), cols_count))
+    if lengths.min() < cols_count:
+        missing = [TABLE_MISSING_VALUES[0]] * cols_count
+        rows = [row + missing[len(row):] if len(row) < cols_count else row for row in rows]
+    tokens = np.array([token for row in rows for token in row])
+    try:
+        values = tokens.astype(np.float64)
+    except ValueError:
+        try:
+            values = np.where(np.isin(tokens, TABLE_MISSING_VALUES + [""]), "nan", tokens).astype(np.float64)
+        except ValueError as e:
+            raise LabGenError("malformed table body: %s" % (e,))
+    return values.reshape((len(rows), cols_count))
+
+
+TEXT_TABLE_CHUNK_LINES = 2 ** 16
+
+
+def load_text_table(path, delimiter=None, body_cache=None):
+    """
+    Reads table from a text file chunk by chunk. If the first line is not numeric, it is treated as header.
+    Returns (rows x cols array, list of column names or None)
+    """
+    with open(path, encoding="utf-8") as file:
+        first_line = file.readline()
+    names = None
+    header = [cell.strip() for cell in first_line.split(delimiter)]
+    try:
+        parse_table_text(first_line, len(header), delimiter)
+    except LabGenError:
+        names = header
+
+    def parse():
+        chunks = []
+        with open(path, encoding="utf-8") as file:
+            if names:
+                file.readline()
+            while True:
+                lines = "".join(itertools.islice(file, TEXT_TABLE_CHUNK_LINES))
+                if not lines:
+                    break
+                chunks.append(parse_table_text(lines, len(header), delimiter))
+        return np.concatenate(chunks) if chunks else np.empty((0, len(header)))
+
+    if body_cache is None:
+        return parse(), names
+    st = os.stat(path)
+    return body_cache.get("%s\n%d\n%d\n%s" % (os.path.abspath(path), st.st_size, st.st_mtime_ns, delimiter),
+                          parse, "%s\n%s" % (os.path.abspath(path), delimiter)), names
+
+
+def evict_cache_entries(directory, max_size=None, max_age=None, keep=()):
+    """
+    Removes files of cache directory which are too old, then least recently used ones (by mtime) until
+    the rest fits max_size. Returns count of removed files
+
+    :param keep: paths which must not be removed
+    """
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.path not in keep:
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    entries.sort(reverse=True)
+    now, total, removed = time.time(), 0, 0
+    for mtime, size, path in entries:
+        total += size
+        if (max_age is not None and now - mtime > max_age) or (max_size is not None and total > max_size):
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # removed by another process
+            total -= size
+            removed += 1
+    return removed
+
+
+class TableBodyCache:
+    """
+    Stores parsed table bodies as .npy files named after hash of the table text.
+    Cached bodies are loaded as read-only memory maps
+    """
+    DEFAULT_MIN_SIZE = 2 ** 16
+
+    def __init__(self, directory, min_size=DEFAULT_MIN_SIZE, max_size=None, max_age=None):
+        """
+        :param min_size: bodies shorter than this (in characters) are cheaper to parse than to load
+        :param max_size: max total size of entries in bytes, or None for no limit
+        :param max_age: max time in seconds since entry was last used, or None for no limit
+        """
+        self.directory = os.path.normpath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_age = max_age
+        # spilled bodies can't be produced again, so they are not evicted while this instance lives
+        self.spilled = set()
+
+    def load(self, text, cols_count):
+        return self.get("%d\n%s" % (cols_count, text), lambda: parse_table_text(text, cols_count))
+
+    def spill(self, array):
+        """
+        Stores array which can't be produced again. Returns path of its .npy file
+        """
+        array = np.ascontiguousarray(array)
+        key = "%s\n%s\n%s" % (array.shape, array.dtype, hashlib.sha1(array.tobytes()).hexdigest())
+        self.get(key, lambda: array)
+        self.spilled.add(self.path(key))
+        return self.path(key)
+
+    def path(self, key, group=None):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        if group is not None:
+            name = hashlib.sha1(group.encode("utf-8")).hexdigest() + "-" + name
+        return self.directory + os.sep + name + os.extsep + "npy"
+
+    def get(self, key, producer, group=None):
+        """
+        :param key: string which identifies the data
+        :param producer: callable which creates the array in case of cache miss
+        :param group: string which identifies the origin of data, e.g. file path; when a new entry is stored,
+            older entries of its group are removed
+        """
+        path = self.path(key, group)
+        if os.path.exists(path):
+            try:
+                rows = np.load(path, mmap_mode="r")
+                os.utime(path)  # entry is evicted in least recently used order
+                return rows
+            except (OSError, ValueError):
+                pass  # broken entry, overwrite it
+        rows = producer()
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as file:
+            np.save(file, rows)
+        os.replace(tmp, path)
+        if group is not None:
+            prefix = os.path.basename(path).split("-", 1)[0] + "-"
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(prefix) and entry.path != path and entry.name.endswith(".npy"):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass  # removed by another process
+        return rows
+
+    def evict(self):
+        """
+        Removes entries which are too old, then least recently used ones until cache fits max_size.
+        Returns count of removed entries
+        """
+        return evict_cache_entries(self.directory, self.max_size, self.max_age, self.spilled)
+
+
+class Curve(PropertyHolder):
+    __slots__ = ("name", "metadata")
 
-class Curve:
     _PROP_COLOR = Property("color",
                            DatafileVariable.METADATA_VALUE_TYPE_STR,
                            default="black")
@@ -307,6 +1105,10 @@ class Curve:
     _PROP_SCOPE = Property("scope",
                            DatafileVariable.METADATA_VALUE_TYPE_STR,
                            default="")
+    # empty means "same as plot"
+    _PROP_DECIMATE = Property("decimate",
+                              DatafileVariable.METADATA_VALUE_TYPE_STR,
+                              default="")
 
     def __init__(self, name, metadata):
         self.name = name
@@ -327,9 +1129,78 @@ class Curve:
     def get_color(self):
         return self.metadata[self._PROP_COLOR.name]
 
+    def get_decimate(self):
+        return self.metadata[self._PROP_DECIMATE.name]
+
+
+def decimate_minmax(x, y, target):
+    """
+    Splits points into (target - 2) / 2 buckets of equal count and keeps the minimum and the maximum of each bucket
+    as well as the first and the last point, preserving order, so at most target points are kept.
+    Assumes x is sorted, like in time series
+    """
+    n, buckets = len(y), (target - 2) // 2
+    if n <= target:
+        return x, y
+    if buckets < 1:
+        indices = np.array([0, n - 1][:max(1, target)])
+        return x[indices], y[indices]
+    size = -(-n // buckets)
+    buckets = -(-n // size)
+    padding = buckets * size - n
+    finite = np.isfinite(y)
+    lows = np.concatenate((np.where(finite, y, np.inf), np.full(padding, np.inf))).reshape((buckets, size))
+    highs = np.concatenate((np.where(finite, y, -np.inf), np.full(padding, -np.inf))).reshape((buckets, size))
+    offsets = np.arange(buckets) * size
+    indices = np.unique(np.concatenate((
+        [0, n - 1], offsets + np.argmin(lows, axis=1), offsets + np.argmax(highs, axis=1))))
+    indices = indices[indices < n]
+    return x[indices], y[indices]
+
+
+def decimate_lttb(x, y, target):
+    """
+    Largest-Triangle-Three-Buckets: keeps target points which preserve visual shape of the curve.
+    Buckets are processed sequentially, points inside a bucket are compared vectorized
+    """
+    n = len(y)
+    if n <= target or target < 3:
+        return x, y
+    edges = np.floor(np.arange(target - 1) * ((n - 2) / (target - 2)) + 1).astype(np.intp)
+    edges[-1] = n - 1
+    fx, fy = np.asarray(x, dtype=np.float64), np.nan_to_num(np.asarray(y, dtype=np.float64))
+    counts = np.diff(edges)
+    # averages of the next bucket for each bucket; the last bucket is followed by the last point
+    avg_x = np.append((np.add.reduceat(fx[:-1], edges[:-1]) / counts)[1:], fx[-1])
+    avg_y = np.append((np.add.reduceat(fy[:-1], edges[:-1]) / counts)[1:], fy[-1])
+    indices = np.empty(target, dtype=np.intp)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(target - 2):
+        start, stop = edges[i], edges[i + 1]
+        areas = np.abs((fx[a] - avg_x[i]) * (fy[start:stop] - fy[a]) -
+                       (fx[a] - fx[start:stop]) * (avg_y[i] - fy[a]))
+        a = indices[i + 1] = start + int(np.argmax(areas))
+    return x[indices], y[indices]
+
+
+DECIMATION_METHODS = {
+    "none": None,
+    "minmax": decimate_minmax,
+    "lttb": decimate_lttb,
+}
+
 
 class Plot(DatafileVariable):
+    __slots__ = ("figure_name", "labgen_instance", "figures")
+
+    LABEL_KIND = "plot"
     AUTOSCALE = "autoscale"
+    # default image target
+    IMAGE_FORMAT = "png"
+    # formats which can be saved
+    IMAGE_FORMATS = ["png", "jpg", "jpeg", "pdf", "eps", "ps", "svg"]
+    TARGET_DPI_CHAR = "@"
 
     DEFINITION = "${2}"
     DEFINITION_PATTERN = create_variable_pattern(DEFINITION, DEFINITION)
@@ -347,54 +1218,397 @@ class Plot(DatafileVariable):
                            DatafileVariable.METADATA_VALUE_TYPE_BUILDER,
                            object_type=Curve,
                            single_value=False)
+    # one of DECIMATION_METHODS
+    _PROP_DECIMATE = Property("decimate",
+                              DatafileVariable.METADATA_VALUE_TYPE_STR,
+                              default="none")
+    # count of points to keep in each curve; 0 means twice the image width in pixels
+    _PROP_DECIMATE_POINTS = Property("decimate_points",
+                                     DatafileVariable.METADATA_VALUE_TYPE_NUMBER,
+                                     default="0")
+    # curves with more points are rasterized in vector formats; 0 disables
+    _PROP_RASTERIZE_THRESHOLD = Property("rasterize_threshold",
+                                         DatafileVariable.METADATA_VALUE_TYPE_NUMBER,
+                                         default="100000")
+    # image targets like png;png@300;pdf, all saved from one drawing; the first one goes into documents.
+    # Empty means LabGen default
+    _PROP_FORMATS = Property("formats",
+                             DatafileVariable.METADATA_VALUE_TYPE_LIST,
+                             default="")
 
     def __init__(self, name, human_readable_name, metadata, labgen_instance):
-        super().__init__(name, human_readable_name, metadata, find_all_properties(Plot))
+        super().__init__(name, human_readable_name, metadata)
         self.figure_name = "figure_" + self.name
         # needed to access tables
         self.labgen_instance = labgen_instance
         self.figures = {}
 
-    def produce_image(self, dpi=None):
-        f = self.figures.get(dpi, None)
+    def prepare_drawing(self, dpi=None):
+        """
+        Evaluates curve expressions and returns everything needed to draw this plot.
+        The result does not reference any LabGen state, so it can be drawn in another process
+        """
+        target = int(self.metadata[self._PROP_DECIMATE_POINTS.name]) or \
+            int(2 * PlotDrawing.WIDTH * (dpi or PlotDrawing.DPI))
+        evaluator, lines = self.labgen_instance.expressions, []
+        with evaluator.plot_namespace(self.referenced_tables(), self.referenced_constants()):
+            scopes = []
+            for curve in self.metadata.get(Plot._PROP_CURVE.name, []):
+                x_expr, y_expr, scope = curve.get_expressions()
+                scopes.append(scope)
+                evaluator.run_scopes(tuple(scopes))  # prepare scope
+                method = curve.get_decimate() or self.metadata[self._PROP_DECIMATE.name]
+                if method not in DECIMATION_METHODS:
+                    raise LabGenError("unknown decimation method %s in plot %s; possible methods are %s" % (
+                        method, self.name, list(DECIMATION_METHODS.keys())))
+                for curve_data_x, curve_data_y in zip(flatten_2d_np_array(evaluator.eval(x_expr)),
+                                                      flatten_2d_np_array(evaluator.eval(y_expr))):
+                    if DECIMATION_METHODS[method] is not None and np.ndim(curve_data_x) == np.ndim(curve_data_y) == 1 \
+                            and len(curve_data_x) == len(curve_data_y):
+                        curve_data_x, curve_data_y = DECIMATION_METHODS[method](
+                            np.asarray(curve_data_x), np.asarray(curve_data_y), target)
+                    lines.append((curve_data_x, curve_data_y, curve.get_style(), curve.get_color()))
+        xlabel, ylabel = self.metadata[self._PROP_AXES.name]
+        return PlotDrawing(xlabel, ylabel, lines,
+                           self.metadata[self._PROP_XRANGE.name], self.metadata[self._PROP_YRANGE.name],
+                           int(self.metadata[self._PROP_RASTERIZE_THRESHOLD.name]))
+
+    def identifiers(self):
+        names = set()
+        for curve in self.metadata.get(Plot._PROP_CURVE.name, []):
+            for expression in curve.get_expressions():
+                names |= find_identifiers(expression)
+        return names
+
+    def referenced_tables(self):
+        """
+        Returns names of tables which are (possibly) used in expressions of this plot,
+        including blocks of used constants
+        """
+        labgen = self.labgen_instance
+        names = self.identifiers()
+        return sorted((names & labgen.tables.keys()) |
+                      {labgen.constants[name].name for name in names & labgen.constants.keys()})
+
+    def referenced_constants(self):
+        return sorted(self.identifiers() & self.labgen_instance.constants.keys())
+
+    @staticmethod
+    def parse_target(string):
+        """
+        Parses image target like "png" or "png@300" into (format, dpi or None)
+        """
+        ext, _, dpi = string.partition(Plot.TARGET_DPI_CHAR)
+        ext = ext.strip().lower()
+        if ext not in Plot.IMAGE_FORMATS:
+            raise LabGenError("unknown image format %s; possible formats are %s" % (ext, Plot.IMAGE_FORMATS))
+        try:
+            return ext, float(dpi) if dpi.strip() else None
+        except ValueError:
+            raise LabGenError("invalid dpi in image target %s" % (string,))
+
+    def targets(self):
+        """
+        Returns list of distinct (format, dpi) image targets of this plot
+        """
+        targets = []
+        for string in self.metadata[self._PROP_FORMATS.name] or self.labgen_instance.figure_formats:
+            target = Plot.parse_target(string)
+            if target not in targets:
+                targets.append(target)
+        return targets
+
+    def target_path(self, target):
+        ext, dpi = target
+        return self.labgen_instance.figures_dir + os.sep + self.figure_name + \
+            ("_%gdpi" % (dpi,) if dpi else "") + os.extsep + ext
+
+    def data_digest(self):
+        """
+        Hash of everything that affects images of this plot besides target: plot metadata and bodies
+        of referenced tables. Bodies are hashed column by column, so they are not copied as a whole
+        """
+        parts = [FigureCache.VERSION,
+                 self.metadata[self._PROP_AXES.name],
+                 str(self.metadata[self._PROP_XRANGE.name]), str(self.metadata[self._PROP_YRANGE.name]),
+                 self.metadata[self._PROP_DECIMATE.name], self.metadata[self._PROP_DECIMATE_POINTS.name],
+                 self.metadata[self._PROP_RASTERIZE_THRESHOLD.name]]
+        for curve in self.metadata.get(Plot._PROP_CURVE.name, []):
+            parts.extend((curve.get_expressions(), curve.get_style(), curve.get_color(), curve.get_decimate()))
+        digest = hashlib.sha1(repr(parts).encode("utf-8"))
+        for name in self.referenced_tables():
+            body = self.labgen_instance.get_table(name).body
+            digest.update(("%s%s%s" % (name, body.shape, body.dtype)).encode("utf-8"))
+            for column in body:
+                digest.update(np.ascontiguousarray(column))
+        # scalar constants are not part of any table body
+        for name, value in self.labgen_instance.constant_values(self.referenced_constants()).items():
+            value = np.ascontiguousarray(value)
+            digest.update(("%s%s%s" % (name, value.shape, value.dtype)).encode("utf-8"))
+            digest.update(value.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def cache_key(target, data_digest):
+        """
+        Figure cache key of image target
+
+        :param data_digest: see data_digest
+        """
+        return hashlib.sha1(("%s\n%s" % (data_digest, target)).encode("utf-8")).hexdigest()
+
+    def produce_image(self):
+        """
+        Produces all image targets of this plot from a single drawing; targets found in figure cache are not redrawn.
+        Returns Figure of the first target. Actual drawing may still be in progress when this returns;
+        see LabGen.join_images
+        """
+        targets = self.targets()
+        f = self.figures.get(targets[0], None)
         if f:
             return f
-        path = self.labgen_instance.figures_dir + os.sep + self.figure_name + (dpi or "")
-        pp.clf()
-        interpreter = asteval.Interpreter({table.name: table.body for table in self.labgen_instance.tables.values()})
-        curves = self.metadata.get(Plot._PROP_CURVE.name, [])
-        xlabel, ylabel = self.metadata[self._PROP_AXES.name]
-        pp.xlabel(xlabel)
-        pp.ylabel(ylabel)
-        # plot data
-        for curve in curves:
-            x_expr, y_expr, scope = curve.get_expressions()
-            interpreter.eval(scope)  # prepare scope
-            for curve_data_x, curve_data_y in zip(flatten_2d_np_array(interpreter.eval(x_expr)),
-                                                  flatten_2d_np_array(interpreter.eval(y_expr))):
-                pp.plot(curve_data_x, curve_data_y,
-                        marker="o", linestyle=curve.get_style(), color=curve.get_color())
-        xrange = self.metadata[self._PROP_XRANGE.name]
-        do_auto_x = False
-        if xrange != Plot.AUTOSCALE:
-            pp.xlim(xrange.start, xrange.stop)
-            do_auto_x = True
-        yrange = self.metadata[self._PROP_YRANGE.name]
-        do_auto_y = False
-        if yrange != Plot.AUTOSCALE:
-            pp.ylim(yrange.start, yrange.stop)
-            do_auto_y = True
-        if do_auto_x and do_auto_y:
-            pp.autoscale()
-        pp.savefig(path)
-        self.figures[dpi] = fig = Figure(path)
-        return fig
+        labgen = self.labgen_instance
+        missing = []
+        data_digest = self.data_digest() if labgen.figure_cache is not None else None
+        for target in targets:
+            path = self.target_path(target)
+            cache_key = None
+            if data_digest is not None:
+                cache_key = Plot.cache_key(target, data_digest)
+                if labgen.figure_cache.fetch(cache_key, path):
+                    labgen.log.info("Figure cache hit for plot %s: %s" % (self.name, path))
+                    continue
+            missing.append((path, target[1], cache_key))
+        if missing:
+            # decimation keeps enough points for the sharpest raster target
+            raster_dpis = [dpi or PlotDrawing.DPI for ext, dpi in targets if ext not in PlotDrawing.VECTOR_FORMATS]
+            with labgen.profile(LabGen.STAGE_EVALUATE_PLOT, self.name):
+                drawing = self.prepare_drawing(max(raster_dpis) if raster_dpis else None)
+            labgen.submit_drawing(drawing, [(path, dpi) for path, dpi, _ in missing],
+                                  [cache_key for _, _, cache_key in missing], self.name)
+        for target in targets:
+            self.figures[target] = Figure(self.target_path(target))
+        return self.figures[targets[0]]
 
     def __str__(self):
         return "Plot<%s; figure_name=%s>" % (
             super().__str__(), self.figure_name
         )
 
+    def __getstate__(self):
+        state = slots_state(self)
+        state["labgen_instance"], state["figures"] = None, {}
+        return None, state
+
+
+class FigureCache:
+    """
+    Content-addressed on-disk storage of produced images. Entries are named after cache keys,
+    so several processes can safely share one cache directory
+    """
+    VERSION = "3"
+
+    def __init__(self, directory, max_size=None, max_age=None):
+        """
+        :param directory: cache directory; created if it does not exist
+        :param max_size: max total size of entries in bytes, or None for no limit
+        :param max_age: max time in seconds since entry was last used, or None for no limit
+        """
+        self.directory = os.path.normpath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits, self.misses = 0, 0
+
+    def entry_path(self, key, ext):
+        return self.directory + os.sep + key + os.extsep + ext
+
+    def fetch(self, key, path):
+        """
+        Puts cached image into path. Returns False if there is no such entry
+        """
+        entry = self.entry_path(key, split_ext(path)[1])
+        if not os.path.exists(entry):
+            self.misses += 1
+            return False
+        os.utime(entry)  # entry is evicted in least recently used order
+        with open(entry, "rb") as file:
+            write_if_changed(path, file.read())
+        self.hits += 1
+        return True
+
+    def store(self, key, path):
+        entry = self.entry_path(key, split_ext(path)[1])
+        tmp = "%s.%d.tmp" % (entry, os.getpid())
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, entry)
+
+    def evict(self):
+        """
+        Removes entries which are too old, then least recently used ones until cache fits max_size.
+        Returns count of removed entries
+        """
+        return evict_cache_entries(self.directory, self.max_size, self.max_age)
+
+    def stats(self):
+        return "Figure cache: %d hit(s), %d miss(es)" % (self.hits, self.misses)
+
+
+class ExpressionEvaluator:
+    """
+    asteval interpreter shared by all plots of a LabGen instance.
+    Expressions are parsed once and cached by their text; results of scope statements are
+    memoized until table data changes (see LabGen.data_version)
+    """
+
+    def __init__(self, labgen_instance):
+        self.labgen_instance = labgen_instance
+        self._interpreter = None
+        self.asts = {}
+        # (data version, scopes executed so far) -> symbols set by the last scope
+        self.scopes = {}
+        self.scopes_version = None
+
+    @property
+    def interpreter(self):
+        if self._interpreter is None:
+            self._interpreter = create_interpreter()
+        return self._interpreter
+
+    def parse(self, expression):
+        node = self.asts.get(expression)
+        if node is None:
+            try:
+                node = self.asts[expression] = self.interpreter.parse(expression)
+            except Exception:
+                return None
+        return node
+
+    def eval_checked(self, expression):
+        """
+        Evaluates expression in the current namespace, raising LabGenError on failure
+        """
+        self.interpreter.error = []
+        result = self.eval(expression)
+        if self.interpreter.error:
+            raise LabGenError("failed to evaluate %s: %s" % (
+                expression, "; ".join("%s: %s" % (getattr(error.exc, "__name__", error.exc), error.msg)
+                                      for error in self.interpreter.error)))
+        return result
+
+    def eval(self, expression):
+        """
+        Evaluates expression in the current namespace. Like asteval, prints errors and returns None on failure
+        """
+        node = self.parse(expression)
+        # on syntax errors, let asteval report them
+        result = self.interpreter.eval(expression if node is None else node)
+        # the interpreter keeps text of each evaluated expression otherwise
+        self.interpreter.code_text = []
+        return result
+
+    def run_scopes(self, scopes):
+        """
+        Makes symbols defined by scope statements available. Only the last scope is executed
+        (if it was not executed in the same context before); previous ones are expected to be applied already
+
+        :param scopes: tuple of scope statements executed for the plot so far
+        """
+        version = self.labgen_instance.data_version
+        if self.scopes_version != version:
+            self.scopes, self.scopes_version = {}, version
+        key = (version, scopes)
+        symbols = self.scopes.get(key)
+        if symbols is None:
+            before = dict(self.interpreter.symtable)
+            self.eval(scopes[-1])
+            symbols = self.scopes[key] = {name: value for name, value in self.interpreter.symtable.items()
+                                          if before.get(name, before) is not value}
+        self.interpreter.symtable.update(symbols)
+
+    @contextlib.contextmanager
+    def plot_namespace(self, table_names, constant_names=()):
+        """
+        Puts tables and constants into namespace; everything defined while evaluating plot is removed afterwards
+        """
+        symtable = self.interpreter.symtable
+        saved = dict(symtable)
+        try:
+            # evaluating constants may use this namespace too, so they go first
+            constants = self.labgen_instance.constant_values(constant_names)
+            for name in table_names:
+                symtable[name] = self.labgen_instance.get_table(name).body
+            symtable.update(constants)
+            yield self
+        finally:
+            symtable.clear()
+            symtable.update(saved)
+
+
+class PlotDrawing:
+    """
+    Evaluated plot data. Draws itself on its own matplotlib Figure, so no global pyplot state is involved
+    """
+
+    # matplotlib defaults
+    WIDTH = 6.4
+    DPI = 100
+
+    VECTOR_FORMATS = ["pdf", "eps", "ps", "svg"]
+
+    # keep dates out of images, so that redrawing an unchanged plot gives the same bytes
+    STABLE_METADATA = {"pdf": {"CreationDate": None}, "svg": {"Date": None}}
+    # PostScript backend takes date only from SOURCE_DATE_EPOCH, so the comment is dropped instead
+    PS_CREATION_DATE_PATTERN = re.compile(rb"^%%CreationDate:[^\n]*\n", re.M)
+    # element ids of SVG images are random unless salted
+    SVG_HASH_SALT = "labgen"
+
+    def __init__(self, xlabel, ylabel, lines, xrange, yrange, rasterize_threshold=0):
+        self.xlabel = xlabel
+        self.ylabel = ylabel
+        self.lines = lines
+        self.xrange = xrange
+        self.yrange = yrange
+        self.rasterize_threshold = rasterize_threshold
+
+    def draw(self, rasterize=False):
+        figure = create_figure()
+        axes = figure.add_subplot()
+        axes.set_xlabel(self.xlabel)
+        axes.set_ylabel(self.ylabel)
+        for x, y, style, color in self.lines:
+            axes.plot(x, y, marker="o", linestyle=style, color=color,
+                      rasterized=rasterize and 0 < self.rasterize_threshold < np.size(y))
+        if not self.xrange.auto_scale:
+            axes.set_xlim(self.xrange.start, self.xrange.stop)
+        if not self.yrange.auto_scale:
+            axes.set_ylim(self.yrange.start, self.yrange.stop)
+        return figure
+
+    def save(self, targets):
+        """
+        Draws the figure once and saves it to every target. Image is written only if its bytes differ
+        from the existing file, through a temporary file, so processes drawing the same plot do not clash.
+        Returns paths, seconds spent drawing and seconds spent saving
+
+        :param targets: list of (path, dpi) pairs; format is taken from path extension
+        """
+        import matplotlib
+        start = time.perf_counter()
+        figure = self.draw(rasterize=any(split_ext(path)[1].lower() in PlotDrawing.VECTOR_FORMATS
+                                         for path, _ in targets))
+        drawn = time.perf_counter()
+        for path, dpi in targets:
+            ext = split_ext(path)[1].lower()
+            buffer = io.BytesIO()
+            with matplotlib.rc_context({"svg.hashsalt": PlotDrawing.SVG_HASH_SALT}):
+                figure.savefig(buffer, dpi=dpi, format=ext, metadata=PlotDrawing.STABLE_METADATA.get(ext))
+            data = buffer.getvalue()
+            if ext in ("ps", "eps"):
+                data = PlotDrawing.PS_CREATION_DATE_PATTERN.sub(b"", data, count=1)
+            write_if_changed(path, data)
+        return [path for path, _ in targets], drawn - start, time.perf_counter() - drawn
+
 
 class Template:
     # patterns and constants
@@ -403,12 +1617,15 @@ class Template:
     OPT_DEFINITION = "@@"
     DEFINITION_PATTERN = create_variable_pattern(DEFINITION, DEFINITION)
     PARAM_INTERPOLATION_PATTERN = re.compile("%{2}(?P<var>[\w_]*)", re.U | re.M)
-    INVOCATION_PATTERN = create_invocation_pattern("#", "|{2}", "|{2}")
+    INVOCATION_CHAR = "#"
+    INVOCATION_PATTERN = create_invocation_pattern(INVOCATION_CHAR, "|{2}", "|{2}")
 
     def __init__(self, name: str, body: str):
         self.name = name
         self.body, self.param_map, self.param_positions, self.opts = self.parse_body(body)
         self._apply_options()
+        self.params = sorted(self.param_positions.keys(), key=lambda param: self.param_positions[param])
+        self.literals, self.slots = self.compile_body()
 
     def _apply_options(self):
         # TODO: refine
@@ -432,23 +1649,56 @@ class Template:
                 body_lines.append(line)
         return "\n".join(body_lines), params, positions, options
 
-    def interpolate_params(self, substitution):
-        def interceptor_func(match):
-            param = match.group("var")
-            position = self.param_positions.get(param, None)
-            if position is None:
-                # parameter does not exists
-                raise LabGenError("parameter \"%s\" is not defined for template \"%s\"" % (param, self.name))
-            # search for value
+    def compile_body(self):
+        """
+        Splits body into literal text and parameter slots: body == literals[0] + slot[0] + literals[1] + ...
+        Slots are stored as parameter names
+        """
+        literals, slots, last = [], [], 0
+        for match in Template.PARAM_INTERPOLATION_PATTERN.finditer(self.body):
+            literals.append(self.body[last:match.start()])
+            slots.append(match.group("var"))
+            last = match.end()
+        literals.append(self.body[last:])
+        return literals, slots
+
+    def resolve_params(self, substitution):
+        """
+        Returns tuple of parameter values (or None, if there is no value) in order of their positions.
+        Two substitutions giving equal tuples produce equal interpolations
+        """
+        values = []
+        for param in self.params:
+            position, value = self.param_positions[param], None
             for possible_location in (substitution, self.param_map):
                 for possible_key in (param, position):
                     value = possible_location.get(possible_key, None)
                     if not (value is None):
-                        # if we have found a value, return it
-                        return value
-            raise LabGenError("no value found for param \"%s\"" % (param,))
+                        break
+                if not (value is None):
+                    break
+            values.append(value)
+        return tuple(values)
+
+    def interpolate_values(self, values):
+        """
+        :param values: result of resolve_params
+        """
+        parts = [self.literals[0]]
+        for param, literal in zip(self.slots, self.literals[1:]):
+            position = self.param_positions.get(param, None)
+            if position is None:
+                # parameter does not exists
+                raise LabGenError("parameter \"%s\" is not defined for template \"%s\"" % (param, self.name))
+            value = values[position]
+            if value is None:
+                raise LabGenError("no value found for param \"%s\"" % (param,))
+            parts.append(value)
+            parts.append(literal)
+        return "".join(parts)
 
-        return Template.PARAM_INTERPOLATION_PATTERN.sub(interceptor_func, self.body)
+    def interpolate_params(self, substitution):
+        return self.interpolate_values(self.resolve_params(substitution))
 
     def __str__(self):
         return "Template<name=\"%s\"; param_map=%s; positions: %s" % (
@@ -457,16 +1707,21 @@ class Template:
 
 
 class Figure:
+    __slots__ = ("path", "ext", "name", "label")
+
     def __init__(self, full_path):
         self.path = full_path
         self.ext = split_ext(full_path)[-1]
         self.name = os.path.basename(full_path)
-        self.label = generate_label(self.name)
+        # file name is not cleaned here: dots and extension make generate_label append a hash, so images with
+        # the same name in different formats, or names like "a.b.png" and "a_b.png", get different labels
+        self.label = generate_label(self.name, "figure")
 
 
 class Command:
     COMMAND_DEF_PREFIX = "cmd_"
-    INVOCATION_PATTERN = create_invocation_pattern("@", "|{2}", "|{2}")
+    INVOCATION_CHAR = "@"
+    INVOCATION_PATTERN = create_invocation_pattern(INVOCATION_CHAR, "|{2}", "|{2}")
 
     def __init__(self, name, exec_method):
         self.name = name
@@ -488,6 +1743,84 @@ class Command:
         return "Command<name=\"%s\"; positional args=%s>" % (self.name, get_method_arg_names(self.command_exec_method))
 
 
+class TextNode:
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return "Text<%r>" % (self.text,)
+
+
+class InvocationNode:
+    """
+    Template or command invocation, e.g. #name||args|| or @name
+    """
+
+    def __init__(self, sigil, name, args, raw):
+        self.sigil = sigil
+        self.name = name
+        self.args = args
+        self.raw = raw
+
+    def __str__(self):
+        return "Invocation<%s%s; args=%r>" % (self.sigil, self.name, self.args)
+
+
+class Lexer:
+    """
+    Splits text into TextNode and InvocationNode list in one linear pass.
+    Syntax is the same as of Template.INVOCATION_PATTERN and Command.INVOCATION_PATTERN:
+    args start after optional whitespace with || and last until the nearest following ||.
+    As templates are expanded before commands are invoked, args of a command may contain template invocations
+    with their own args, like @ref||#name||x||||; the nested ||...|| pairs do not end args of the command
+    """
+    ARGS_DELIMITER = "||"
+    ARGS_START_PATTERN = re.compile(r"\s*\|\|", re.U)
+    NESTED_ARGS_START_PATTERN = re.compile(r"%s[\w_]+\s*\|\|" % (re.escape(Template.INVOCATION_CHAR),), re.U)
+
+    def __init__(self, sigils=Template.INVOCATION_CHAR + Command.INVOCATION_CHAR):
+        self.start_pattern = re.compile(r"([%s])([\w_]+)" % (re.escape(sigils),), re.U)
+
+    def tokenize(self, string):
+        nodes, position = [], 0
+        for match in self.start_pattern.finditer(string):
+            start = match.start()
+            if start < position:
+                # inside args of the previous invocation
+                continue
+            if start > position:
+                nodes.append(TextNode(string[position:start]))
+            end, args = match.end(), None
+            args_start = Lexer.ARGS_START_PATTERN.match(string, end)
+            if args_start:
+                args_end = self.find_args_end(string, args_start.end(), match.group(1) != Template.INVOCATION_CHAR)
+                if args_end != -1:
+                    args = string[args_start.end():args_end]
+                    end = args_end + len(Lexer.ARGS_DELIMITER)
+            nodes.append(InvocationNode(match.group(1), match.group(2), args, string[start:end]))
+            position = end
+        if position < len(string):
+            nodes.append(TextNode(string[position:]))
+        return nodes
+
+    @staticmethod
+    def find_args_end(string, start, skip_nested=True):
+        """
+        Returns position of || which closes args starting at start, or -1
+        """
+        end = string.find(Lexer.ARGS_DELIMITER, start)
+        while skip_nested and end != -1:
+            nested = Lexer.NESTED_ARGS_START_PATTERN.search(string, start, end + len(Lexer.ARGS_DELIMITER))
+            if nested is None:
+                break
+            nested_end = string.find(Lexer.ARGS_DELIMITER, nested.end())
+            if nested_end == -1:
+                break
+            start = nested_end + len(Lexer.ARGS_DELIMITER)
+            end = string.find(Lexer.ARGS_DELIMITER, start)
+        return end
+
+
 # Commands are defined as following:
 # 1. Command core function name should start with COMMAND_DEF_PREFIX; the rest of the name will be used as command name
 # 2. Command should take LabGen instance as first argument, any count of positional arguments and **kwargs
@@ -542,8 +1875,7 @@ def cmd_plot(parser, plot_var, **kwargs):
     """
     Creates a plot image using pyplot
     """
-    plot = parser.plots[plot_var]
-    # dpi = kwargs.get("dpi", None)
+    plot = parser.get_plot(plot_var)
     figure = plot.produce_image()
     return cmd_fig_by_path(parser, figure.path, figure.label, plot.human_readable_name, **kwargs)
 
@@ -552,34 +1884,131 @@ def cmd_table_caption(parser, table_var, **kwargs):
     """
     Returns table name
     """
-    return parser.tables[table_var].human_readable_name
+    return parser.get_table(table_var).human_readable_name
 
 
 def cmd_table_body(parser, table_var, **kwargs):
     """
-    Generates table body
+    Generates table body. Output is produced in chunks of TABLE_BODY_CHUNK_ROWS rows
+
+    kwargs: split_each=False, cast_to_int=False, precision=3,
+    formats=<';'-separated per-column formats, one of TableFormatter.FORMATS>
+    """
+    formatter = TableFormatter.from_kwargs(parser.get_table(table_var), kwargs)
+    yield formatter.header()
+    yield from formatter.iter_body()
+
 
-    kwargs: split_each=False, cast_to_int=False, precision=3
+TABLE_BODY_CHUNK_ROWS = 1000
+
+
+class TableFormatter:
+    """
+    Formats table body into LaTeX rows. Each column is formatted at once for a block of rows
     """
-    table = parser.tables[table_var]
-    split_each = kwargs.get("split_each", False)
-    precision = int(kwargs.get("precision", 3))
-    cast_to_int = bool(kwargs.get("cast_to_int", False))
-    header = " & ".join(table.metadata["cols"]) + "\\\\\n\\hline\n"
-    return header + ("\n\\hline\n" if split_each else "\n").join(
-        [np.array2string(row,
-                         separator=" & ",
-                         precision=precision,
-                         formatter={"all": lambda x: str(x if not cast_to_int else int(x))})[1:-1]  # esc np default []
-         + r" \\" for row in table.body.transpose()])
+    FORMATS = {
+        "f": "%.{precision}f",
+        "e": "%.{precision}e",
+        "g": "%.{precision}g",
+        "d": "%.0f",
+        # f, or e for columns which f would show as zeros or too long, see auto_format
+        "a": None,
+    }
+    # magnitude from which auto format of column is e, like in np.array2string
+    AUTO_FORMAT_MAX = 1e8
+
+    def __init__(self, table, precision=3, cast_to_int=False, formats=None, split_each=False):
+        self.cols = table.get_cols()
+        # columns of body are rows of the table
+        self.columns = list(table.body)
+        self.rows_count = len(self.columns[0]) if self.columns else 0
+        default = "d" if cast_to_int else "a"
+        formats = list(formats or [])
+        formats += [default] * (len(self.columns) - len(formats))
+        for f in formats:
+            if f not in TableFormatter.FORMATS:
+                raise LabGenError("unknown column format %s; possible formats are %s" % (
+                    f, list(TableFormatter.FORMATS.keys())))
+        self.precision = precision
+        self.formats = [self.auto_format(column) if f == "a" else f for column, f in zip(self.columns, formats)]
+        self.separator = "\n\\hline\n" if split_each else "\n"
+
+    @staticmethod
+    def from_kwargs(table, kwargs):
+        to_bool = DatafileVariable.CONVERTERS[DatafileVariable.METADATA_VALUE_TYPE_BOOL]
+        return TableFormatter(table,
+                              precision=int(kwargs.get("precision", 3)),
+                              cast_to_int=to_bool(kwargs.get("cast_to_int", "0")),
+                              formats=DatafileVariable.CONVERTERS[DatafileVariable.METADATA_VALUE_TYPE_LIST](
+                                  kwargs.get("formats", "")),
+                              split_each=to_bool(kwargs.get("split_each", "0")))
+
+    def auto_format(self, column):
+        """
+        Returns e if some nonzero value of column is too small to show a digit with precision, or too large;
+        f otherwise
+        """
+        magnitudes = np.abs(np.asarray(column, dtype=np.float64))
+        magnitudes = magnitudes[np.isfinite(magnitudes) & (magnitudes > 0)]
+        if len(magnitudes) and (magnitudes.min() < 10.0 ** -self.precision or
+                                magnitudes.max() >= TableFormatter.AUTO_FORMAT_MAX):
+            return "e"
+        return "f"
+
+    def header(self):
+        return " & ".join(self.cols) + "\\\\\n\\hline\n"
+
+    def format_column(self, column, fmt):
+        column = np.asarray(column)
+        if fmt == "d":
+            # truncate like int() does; + 0.0 gets rid of negative zeros
+            column = np.trunc(column) + 0.0
+        return np.char.mod(TableFormatter.FORMATS[fmt].format(precision=self.precision), column).tolist()
+
+    def format_rows(self, start, stop):
+        """
+        Returns list of formatted rows [start, stop)
+        """
+        formatted = [self.format_column(column[start:stop], fmt) for column, fmt in zip(self.columns, self.formats)]
+        return [" & ".join(cells) + r" \\" for cells in zip(*formatted)]
+
+    def iter_body(self, start=0, stop=None):
+        """
+        Yields rows [start, stop) joined by separator, in chunks of TABLE_BODY_CHUNK_ROWS rows
+        """
+        stop = self.rows_count if stop is None else min(stop, self.rows_count)
+        for block_start in range(start, stop, TABLE_BODY_CHUNK_ROWS):
+            yield ("" if block_start == start else self.separator) + self.separator.join(
+                self.format_rows(block_start, min(block_start + TABLE_BODY_CHUNK_ROWS, stop)))
 
 
 def cmd_table(parser, table_var, **kwargs):
     """
     Generates full table
+
+    kwargs: modifiers="h!", longtable=False,
+    chunk_rows=0 (if set, table is split into several tables of at most that many rows),
+    and kwargs of table_body
     """
-    table = parser.tables[table_var]
-    return r"""\begin{{table}}[{modifiers}]
+    table = parser.get_table(table_var)
+    formatter = TableFormatter.from_kwargs(table, kwargs)
+    columns = ("c|" * len(formatter.cols))[:-1]
+    if DatafileVariable.CONVERTERS[DatafileVariable.METADATA_VALUE_TYPE_BOOL](kwargs.get("longtable", "0")):
+        yield r"""\begin{{longtable}}{{{columns}}}
+        \caption{{{caption}}}
+        \label{{{label}}}\\
+        \hline
+        {header}\endfirsthead
+        \hline
+        {header}\endhead
+        """.format(columns=columns, caption=table.human_readable_name, label=table.label,
+                   header=formatter.header())
+        yield from formatter.iter_body()
+        yield r"""
+        \hline
+        \end{longtable}"""
+        return
+    head, tail = r"""\begin{{table}}[{modifiers}]
         \caption{{{caption}}}
         \label{{{label}}}
             \begin{{center}}
@@ -589,13 +2018,19 @@ def cmd_table(parser, table_var, **kwargs):
                 \hline
                 \end{{tabular}}
             \end{{center}}
-        \end{{table}}""".format(
-        modifiers=kwargs.get("modifiers", "h!"),
-        caption=table.human_readable_name,
-        label=table.label,
-        columns=("c|" * len(table.metadata["cols"]))[:-1],
-        table_body=cmd_table_body(parser, table_var, **kwargs)
-    )
+        \end{{table}}""".split("{table_body}")
+    chunk_rows = int(kwargs.get("chunk_rows", 0)) or max(formatter.rows_count, 1)
+    for start in range(0, max(formatter.rows_count, 1), chunk_rows):
+        yield ("\n" if start else "") + head.format(
+            modifiers=kwargs.get("modifiers", "h!"),
+            caption=table.human_readable_name + (" (continued)" if start else ""),
+            # only the first part can be referenced
+            label=table.label if not start else table.label + "_part%d" % (start // chunk_rows,),
+            columns=columns
+        )
+        yield formatter.header()
+        yield from formatter.iter_body(start, start + chunk_rows)
+        yield tail.format()
 
 
 COMMAND_DEFINITIONS = {
@@ -609,6 +2044,320 @@ COMMAND_DEFINITIONS = {
     }
 
 
+class HeaderFile:
+    """
+    Parsed contents of a single header (.lgt or .lgd) file. Does not depend on LabGen state,
+    so headers can be parsed in worker processes and merged into LabGen afterwards
+    """
+
+    def __init__(self, path=None, templates=(), tables=(), plots=()):
+        self.path = path
+        self.templates = list(templates)
+        self.tables = list(tables)
+        self.plots = list(plots)
+        # entity -> hash of its definition text, see LabGen.KIND_* constants
+        self.digests = {}
+
+    def add(self, kind, item, match):
+        {LabGen.KIND_TEMPLATE: self.templates, LabGen.KIND_TABLE: self.tables, LabGen.KIND_PLOT: self.plots}[
+            kind].append(item)
+        self.digests[(kind, item.name)] = HeaderSnapshot.digest(match.group(0))
+
+    @staticmethod
+    def parse_templates(string, path=None):
+        header = HeaderFile(path)
+        for match in Template.DEFINITION_PATTERN.finditer(string):
+            header.add(LabGen.KIND_TEMPLATE, Template(match.group("name"), match.group("info")), match)
+        return header
+
+    @staticmethod
+    def parse_data(string, path=None, base_dir=None, body_cache=None):
+        """
+        :param base_dir: directory against which relative table sources are resolved
+        """
+        header = HeaderFile(path)
+        # we do this in 3 stages
+        # 1. parse all tables; bodies are parsed on first access
+        for match in Table.DEFINITION_PATTERN.finditer(string):
+            name, hr_name, metadata = match.group("name"), match.group("caption"), match.group("metadata")
+            body = TextSlice(string, *match.span("body")) if match.group("body") is not None else ""
+            header.add(LabGen.KIND_TABLE, Table(name, hr_name, metadata.strip(), body, body_cache, base_dir), match)
+        # 2. parse all constants; they are evaluated on first use
+        for match in DerivedTable.DEFINITION_PATTERN.finditer(string):
+            name, hr_name, definitions = match.group("name"), match.group("caption"), match.group("info")
+            header.add(LabGen.KIND_TABLE, DerivedTable(name, hr_name, definitions), match)
+        # 3. parse all plots
+        for match in Plot.DEFINITION_PATTERN.finditer(string):
+            name, hr_name, metadata = match.group("name"), match.group("caption"), match.group("info")
+            header.add(LabGen.KIND_PLOT, Plot(name, hr_name, metadata, None), match)
+        return header
+
+    @staticmethod
+    def parse(path, string, body_cache=None):
+        ext = split_ext(path)[1]
+        if ext == LabGen.DATA_FILE_FORMAT:
+            return HeaderFile.parse_data(string, path, os.path.dirname(path), body_cache)
+        if ext == LabGen.TEMPLATE_FILE_FORMAT:
+            return HeaderFile.parse_templates(string, path)
+        return HeaderFile(path)
+
+    @staticmethod
+    def parse_timed(path, string, body_cache=None):
+        """
+        Returns parsed header and seconds spent parsing it, so timings of worker processes can be reported
+        """
+        start = time.perf_counter()
+        header = HeaderFile.parse(path, string, body_cache)
+        return header, time.perf_counter() - start
+
+    def entities(self):
+        return [(LabGen.KIND_TEMPLATE, t.name) for t in self.templates] + \
+               [(LabGen.KIND_TABLE, t.name) for t in self.tables] + \
+               [(LabGen.KIND_PLOT, p.name) for p in self.plots]
+
+
+class HeaderSnapshot:
+    """
+    Parsed header files saved between runs. An entry is reused if file size and mtime did not change,
+    or if they did, but contents hash is the same
+    """
+    VERSION = 6
+
+    def __init__(self, path):
+        self.path = path
+        # file path -> (size, mtime, content hash, HeaderFile)
+        self.files = {}
+        self.changed = False
+        self.hits, self.misses = 0, 0
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = pickle.load(file)
+            if data.get("version") == HeaderSnapshot.VERSION:
+                self.files = data["files"]
+        except Exception:
+            # missing, outdated or broken snapshot: everything will be parsed
+            self.files = {}
+        return self
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def fetch(self, path, text=None, stat=None):
+        """
+        Returns HeaderFile parsed from path, or None. If text is given, entry is validated by hash
+
+        :param stat: (size, mtime_ns) of file, if known already
+        """
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+        size, mtime, digest, header = entry
+        if stat is None:
+            st = os.stat(path)
+            stat = (st.st_size, st.st_mtime_ns)
+        if stat == (size, mtime):
+            self.hits += 1
+            return header
+        if text is not None and HeaderSnapshot.digest(text) == digest:
+            self.files[path] = (stat[0], stat[1], digest, header)
+            self.changed = True
+            self.hits += 1
+            return header
+        return None
+
+    def store(self, path, text, header):
+        st = os.stat(path)
+        self.files[path] = (st.st_size, st.st_mtime_ns, HeaderSnapshot.digest(text), header)
+        self.changed = True
+        self.misses += 1
+
+    def save(self):
+        for path in [path for path in self.files if not os.path.exists(path)]:
+            del self.files[path]
+            self.changed = True
+        if not self.changed:
+            return
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as file:
+            pickle.dump({"version": HeaderSnapshot.VERSION, "files": self.files}, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.changed = False
+
+    def stats(self):
+        return "Header snapshot: %d file(s) reused, %d parsed" % (self.hits, self.misses)
+
+
+class SourceIndex:
+    """
+    Sizes and mtimes of sources rendered in previous runs, along with everything else their output depends on
+    (see LabGen.render_environment), entities they used and states of data files of used tables.
+    Lets unchanged sources be skipped without reading them
+    """
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        # source path -> (size, mtime, environment, used entities, data file states)
+        self.files = {}
+        self.changed = False
+        self.skipped = 0
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                data = pickle.load(file)
+            if data.get("version") == SourceIndex.VERSION:
+                self.files = data["files"]
+        except Exception:
+            # missing, outdated or broken index: everything will be rendered
+            self.files = {}
+        return self
+
+    def fetch(self, path, stat, environment, data_states):
+        """
+        Returns entities used by source, if it was rendered with the same stat and environment and data files
+        of tables it used did not change; otherwise None
+
+        :param data_states: callable which returns states of data files used by given entities,
+            see LabGen.data_states
+        """
+        entry = self.files.get(path)
+        if entry is None or entry[:3] != (stat[0], stat[1], environment) or data_states(entry[3]) != entry[4]:
+            return None
+        self.skipped += 1
+        return entry[3]
+
+    def usages(self, path):
+        """
+        Returns entities used by source when it was rendered last time, or None
+        """
+        entry = self.files.get(path)
+        return None if entry is None else entry[3]
+
+    def store(self, path, stat, environment, usages, data_states):
+        self.files[path] = (stat[0], stat[1], environment, frozenset(usages), data_states)
+        self.changed = True
+
+    def discard(self, path):
+        if self.files.pop(path, None) is not None:
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as file:
+            pickle.dump({"version": SourceIndex.VERSION, "files": self.files}, file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        self.changed = False
+
+    def stats(self):
+        return "Source index: %d unchanged source(s) skipped" % (self.skipped,)
+
+
+class Profiler:
+    """
+    Profile hook for LabGen (see LabGen.add_profile_hook): count, total and max seconds per stage and name.
+    Times of nested stages are inclusive, e.g. command time includes loading tables it uses
+    """
+    # stages listed in summary by name
+    SUMMARY_STAGES = ("expand template", "invoke command", "evaluate plot", "draw plot", "save plot", "load table",
+                      "evaluate constant")
+
+    def __init__(self):
+        # (stage, name) -> [count, total, max]
+        self.records = {}
+        self.started = time.perf_counter()
+
+    def __call__(self, stage, name, seconds):
+        record = self.records.get((stage, name))
+        if record is None:
+            self.records[(stage, name)] = [1, seconds, seconds]
+        else:
+            record[0] += 1
+            record[1] += seconds
+            record[2] = max(record[2], seconds)
+
+    def stages(self):
+        """
+        Returns stage -> [count, total, max] over all names
+        """
+        stages = {}
+        for (stage, _), (count, total, max_) in self.records.items():
+            record = stages.setdefault(stage, [0, 0.0, 0.0])
+            record[0] += count
+            record[1] += total
+            record[2] = max(record[2], max_)
+        return stages
+
+    def as_dict(self):
+        return {
+            "wall": time.perf_counter() - self.started,
+            "stages": {stage: {"count": count, "total": total, "max": max_}
+                       for stage, (count, total, max_) in sorted(self.stages().items())},
+            "entries": [{"stage": stage, "name": name, "count": count, "total": total, "max": max_}
+                        for (stage, name), (count, total, max_) in
+                        sorted(self.records.items(), key=lambda item: -item[1][1])],
+        }
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.as_dict(), file, indent=1)
+
+    def summary(self, top=10):
+        """
+        Returns lines of a table with totals per stage and the slowest entries of SUMMARY_STAGES
+        """
+        lines = ["%-22s %8s %10s %10s" % ("stage", "count", "total, s", "max, s")]
+        for stage, (count, total, max_) in sorted(self.stages().items(), key=lambda item: -item[1][1]):
+            lines.append("%-22s %8d %10.3f %10.3f" % (stage, count, total, max_))
+        for summary_stage in Profiler.SUMMARY_STAGES:
+            entries = sorted(((total, count, max_, name) for (stage, name), (count, total, max_)
+                              in self.records.items() if stage == summary_stage), reverse=True)[:top]
+            if not entries:
+                continue
+            lines.append("slowest: %s" % (summary_stage,))
+            for total, count, max_, name in entries:
+                lines.append("  %-20s %8d %10.3f %10.3f" % (name, count, total, max_))
+        return lines
+
+
+# LabGen instance inherited by forked batch workers, see LabGen.render_batch
+_batch_instance = None
+
+
+def _init_batch_worker():
+    lg = _batch_instance
+    # images of a report are drawn by the worker itself; parent's pools and pending work are not ours
+    lg.jobs, lg._process_executor, lg._thread_executor, lg._pending_images = 1, None, None, []
+    # caches and indexes are saved by parent
+    lg.snapshot, lg.source_index = None, None
+    # profile events are sent back to parent with results
+    lg._batch_events = []
+    if lg._profile_hooks:
+        lg._profile_hooks = [lambda *event: lg._batch_events.append(event)]
+
+
+def _render_batch_item(path, encoding):
+    """
+    Renders one source in a batch worker. Returns error message (None on success), entities used by the source
+    and profile events
+    """
+    lg = _batch_instance
+    error = None
+    try:
+        if not lg.render_file(path, encoding):
+            error = "output file was not written"
+        lg.join_images()
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    events, lg._batch_events = lg._batch_events, []
+    return error, lg.dependencies.usages.get(path, set()), events
+
+
 class LabGen:
     ARGS_ITEM_PATTERN = re.compile(r"(?:\s*(?P<key>\w*)\s*=\s*(?P<kwarg>[^|]*)|(?P<arg>[^|]+))\|?", re.U | re.M | re.S)
     #                                                    put * here ^ in case of troubles with empty arguments
@@ -622,18 +2371,90 @@ class LabGen:
     SOURCE_FILE_FORMAT = "lgs"
     OUTPUT_FILE_FORMAT = "tex"
 
-    ALLOWED_FIGURE_FORMAT = ["png", "jpg", "eps", "svg", "jpeg", "gif"]
-
-    def __init__(self, output_dir, figures_dir=None, log_level="DEBUG"):
+    ALLOWED_FIGURE_FORMAT = ["png", "jpg", "eps", "svg", "jpeg", "gif", "pdf"]
+
+    OUTPUT_BUFFER_SIZE = 2 ** 16
+
+    KIND_TEMPLATE = "template"
+    KIND_COMMAND = "command"
+    KIND_TABLE = "table"
+    KIND_PLOT = "plot"
+    KIND_FIGURE = "figure"
+
+    DEFAULT_CACHE_DIR = ".labgen-cache"
+
+    # template expansions kept by trim_memory
+    MAX_EXPANSIONS = 10000
+
+    STAGE_READ_HEADERS = "read headers"
+    STAGE_PARSE_HEADER = "parse header"
+    STAGE_RESOLVE_META_TABLES = "resolve meta tables"
+    STAGE_LOAD_TABLE = "load table"
+    STAGE_RENDER_SOURCE = "render source"
+    STAGE_EXPAND_TEMPLATE = "expand template"
+    STAGE_INVOKE_COMMAND = "invoke command"
+    STAGE_EVALUATE_PLOT = "evaluate plot"
+    STAGE_EVALUATE_CONSTANT = "evaluate constant"
+    STAGE_DRAW_PLOT = "draw plot"
+    STAGE_SAVE_PLOT = "save plot"
+
+    def __init__(self, output_dir, figures_dir=None, log_level="DEBUG", jobs=1,
+                 cache_dir=None, use_cache=True, cache_max_size=None, cache_max_age=None, figure_formats=None,
+                 include=(), exclude=(), skip_unchanged=False, table_cache_max_size=None):
+        """
+        :param cache_max_size: max size of figure cache in bytes
+        :param cache_max_age: max seconds since entry of figure or table cache was last used
+        :param table_cache_max_size: max size of table cache in bytes
+        :param figure_formats: image targets of plots without formats property, e.g. ["png", "png@300", "pdf"]
+        :param include: glob patterns; header and source files must match one of them, if any are given
+        :param exclude: glob patterns of header and source files and directories to ignore
+        :param skip_unchanged: do not render sources which did not change since last run, if headers, figures
+            and image targets did not change either (needs cache). Note that output of commands like @date
+            is not refreshed then
+        """
         self.output_dir = os.path.normpath(output_dir)
         if not os.path.exists(self.output_dir):
             os.mkdir(self.output_dir)
-        self.figures_dir = os.path.normpath(figures_dir) or (output_dir + os.sep + LabGen.DEFAULT_FIGURES_DIR)
+        self.figures_dir = os.path.normpath(figures_dir or (output_dir + os.sep + LabGen.DEFAULT_FIGURES_DIR))
         if not os.path.exists(self.figures_dir):
             os.mkdir(self.figures_dir)
         self.templates, self.tables, self.plots, self.constants, self.figures = \
             {}, {}, {}, {}, {}
         self.log = self._prepare_logger(log_level)
+        self.jobs = max(1, int(jobs or 1))
+        self.figure_formats = list(figure_formats or [Plot.IMAGE_FORMAT])
+        for target in self.figure_formats:
+            Plot.parse_target(target)
+        self._process_executor = None
+        self._thread_executor = None
+        self._pending_images = []
+        self.dependencies = DependencyGraph()
+        # incremented each time tables are (re)defined
+        self.data_version = 0
+        # table name -> tick of last use, for eviction of least recently used tables
+        self._table_uses, self._table_clock = {}, itertools.count()
+        # values of constants (see DerivedTable) evaluated for data version
+        self._constant_values, self._constants_version = {}, None
+        self.expressions = ExpressionEvaluator(self)
+        self.lexer = Lexer()
+        self.command_lexer = Lexer(Command.INVOCATION_CHAR)
+        # (template name, parameter values) -> (expanded nodes, names of nested templates)
+        self._expansions = {}
+        self._usages = None
+        self._profile_hooks = []
+        self.cache_dir = os.path.normpath(cache_dir or (self.output_dir + os.sep + LabGen.DEFAULT_CACHE_DIR))
+        self.figure_cache = FigureCache(self.cache_dir + os.sep + "figures", cache_max_size, cache_max_age) \
+            if use_cache else None
+        self.table_cache = TableBodyCache(self.cache_dir + os.sep + "tables", max_size=table_cache_max_size,
+                                          max_age=cache_max_age) if use_cache else None
+        self.snapshot = HeaderSnapshot(self.cache_dir + os.sep + "headers.snapshot").load() if use_cache else None
+        self.include, self.exclude = tuple(include or ()), tuple(exclude or ())
+        self.skip_unchanged = skip_unchanged
+        self.source_index = SourceIndex(self.cache_dir + os.sep + "sources.index").load() if use_cache else None
+        # header path -> (size, mtime_ns) of processed header files
+        self._header_states = {}
+        # data file path -> (size, mtime_ns) of external table sources, see refresh_data_files
+        self._data_file_states = {}
         self._load_figures()
 
     @staticmethod
@@ -651,14 +2472,109 @@ class LabGen:
             position += 1
         return kwargs
 
+    def add_profile_hook(self, hook):
+        """
+        :param hook: callable(stage, name, seconds), called after each timed operation; stage is one of
+            LabGen.STAGE_* constants. See Profiler
+        """
+        self._profile_hooks.append(hook)
+
+    def remove_profile_hook(self, hook):
+        self._profile_hooks.remove(hook)
+
+    def _profiled(self, stage, name, seconds):
+        for hook in self._profile_hooks:
+            hook(stage, name, seconds)
+
+    @contextlib.contextmanager
+    def profile(self, stage, name=""):
+        """
+        Reports time spent in the block to profile hooks
+        """
+        if not self._profile_hooks:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._profiled(stage, name, time.perf_counter() - start)
+
+    def _use(self, kind, name):
+        if self._usages is not None:
+            self._usages.add((kind, name))
+
+    def get_table(self, name):
+        # usage is recorded even if table is missing, so that source is rendered again once it is defined
+        self._use(LabGen.KIND_TABLE, name)
+        table = self.tables.get(name)
+        if table is None:
+            raise LabGenError("no table with name %s" % (name,))
+        self._table_uses[name] = next(self._table_clock)
+        if self._profile_hooks and not table.materialized:
+            with self.profile(LabGen.STAGE_LOAD_TABLE, name):
+                table.body
+        return table
+
+    def get_plot(self, name):
+        self._use(LabGen.KIND_PLOT, name)
+        plot = self.plots.get(name)
+        if plot is None:
+            raise LabGenError("no plot with name %s" % (name,))
+        for table_name in plot.referenced_tables():
+            self._use(LabGen.KIND_TABLE, table_name)
+        return plot
+
+    def constant_dependencies(self, name):
+        """
+        Returns names of constants used by constant; using a block by its name means using all its constants
+        """
+        block = self.constants.get(name)
+        if block is None:
+            raise LabGenError("no constant with name %s" % (name,))
+        dependencies = []
+        for identifier in sorted(find_identifiers(block.expressions[name])):
+            if identifier in self.constants:
+                dependencies.append(identifier)
+            elif isinstance(self.tables.get(identifier), DerivedTable):
+                dependencies.extend(self.tables[identifier].expressions)
+        return dependencies
+
+    def constant_values(self, names):
+        """
+        Returns dict of values of constants. Constants are evaluated in dependency order, vectorized over
+        table bodies, once per data version
+        """
+        if self._constants_version != self.data_version:
+            self._constant_values, self._constants_version = {}, self.data_version
+        values = self._constant_values
+        for name in topological_order(list(names), self.constant_dependencies):
+            if name in values:
+                continue
+            expression = self.constants[name].expressions[name]
+            identifiers = find_identifiers(expression)
+            with self.profile(LabGen.STAGE_EVALUATE_CONSTANT, name), \
+                    self.expressions.plot_namespace(sorted(identifiers & self.tables.keys())) as evaluator:
+                evaluator.interpreter.symtable.update({n: values[n] for n in identifiers if n in values})
+                try:
+                    values[name] = evaluator.eval_checked(expression)
+                except LabGenError as e:
+                    raise LabGenError("constant %s of %s: %s" % (name, self.constants[name].name, e))
+        return {name: values[name] for name in names}
+
     def find_variable(self, var_name):
-        for pool in (self.tables, self.plots, self.figures):
+        for kind, pool in ((LabGen.KIND_TABLE, self.tables),
+                           (LabGen.KIND_PLOT, self.plots),
+                           (LabGen.KIND_FIGURE, self.figures)):
+            # each kind is recorded, as any of them may be defined later
+            self._use(kind, var_name)
             v = pool.get(var_name)
             if not (v is None):
                 return v
         raise LabGenError("no variable with name %s" % (var_name,))
 
     def get_figure(self, figure_name):
+        self._use(LabGen.KIND_FIGURE, figure_name)
         figure = self.figures.get(figure_name)
         if not (figure is None):
             return figure
@@ -668,98 +2584,705 @@ class LabGen:
         self.figures[figure_name] = fig = Figure(path)
         return fig
 
-    def _resolve_templates(self, string, outer_templates, recursion_level):
-        def interceptor_func(match):
-            nonlocal outer_templates, recursion_level
-            template_name = match.group("var")
+    def submit_drawing(self, drawing, targets, cache_keys=None, name=None):
+        """
+        Draws plot once and saves it to all targets. This is done in a worker process with more than one job,
+        or in a background thread otherwise, so rendering goes on meanwhile.
+        Images are only guaranteed to exist after join_images
+
+        :param targets: list of (path, dpi) pairs
+        :param cache_keys: figure cache key of each target, or None
+        :param name: plot name, used in profile
+        """
+        executor = self._process_pool() if self.jobs > 1 else self._thread_pool()
+        self._pending_images.append((executor.submit(drawing.save, targets),
+                                     cache_keys or [None] * len(targets), name))
+
+    def _image_done(self, result, cache_keys, name=None):
+        paths, draw_seconds, save_seconds = result
+        self._profiled(LabGen.STAGE_DRAW_PLOT, name or paths[0], draw_seconds)
+        self._profiled(LabGen.STAGE_SAVE_PLOT, name or paths[0], save_seconds)
+        for path, cache_key in zip(paths, cache_keys):
+            self.log.info("Image written: %s" % (path,))
+            if cache_key is not None and self.figure_cache is not None:
+                self.figure_cache.store(cache_key, path)
+
+    def join_images(self):
+        """
+        Waits for all submitted images to be written
+        """
+        pending, self._pending_images = self._pending_images, []
+        failures = []
+        for future, cache_keys, name in pending:
+            try:
+                self._image_done(future.result(), cache_keys, name)
+            except Exception as e:
+                failures.append(e)
+        if failures:
+            raise LabGenError("Failed to produce %d image(s): %s" % (len(failures), "; ".join(map(str, failures))))
+
+    def close(self):
+        try:
+            self.join_images()
+        finally:
+            self._shutdown_pools()
+            if self.snapshot is not None:
+                self.snapshot.save()
+            if self.source_index is not None:
+                self.source_index.save()
+                if self.skip_unchanged:
+                    self._log_stage(self.source_index.stats())
+            if self.figure_cache is not None:
+                removed = self.figure_cache.evict()
+                self._log_stage("%s; %d entries evicted" % (self.figure_cache.stats(), removed))
+            if self.table_cache is not None:
+                self.table_cache.evict()
+
+    def _expand(self, nodes, outer_templates, recursion_level, used_templates=None):
+        """
+        Expands template invocations. Yields TextNode and command InvocationNode objects
+        """
+        for node in nodes:
+            if isinstance(node, TextNode) or node.sigil != Template.INVOCATION_CHAR:
+                yield node
+                continue
+            template_name = node.name
             if outer_templates and template_name == outer_templates[-1]:
                 raise LabGenError("Recursive template calls are not allowed. Stack: " + str(outer_templates))
-            template = self.templates[template_name]
-            substitution = LabGen.parse_args(match.group("args") or "")
-            self.log.info(recursion_level * "\t" +
-                          "Applying substitution %s in %s invocation" % (
-                              str(substitution),
-                              "[" + "->".join(outer_templates) + ("->" if outer_templates else "") + template_name + "]"
-                          ))
-            return self._resolve_templates(template.interpolate_params(substitution),
-                                           outer_templates + [template_name], recursion_level + 1)
-
-        return Template.INVOCATION_PATTERN.sub(interceptor_func, string)
+            self._use(LabGen.KIND_TEMPLATE, template_name)
+            template = self.templates.get(template_name)
+            if template is None:
+                raise LabGenError("No such template: #\"%s\"" % (template_name,))
+            substitution = LabGen.parse_args(node.args or "")
+            values = template.resolve_params(substitution)
+            expansion = self._expansions.get((template_name, values))
+            if expansion is None:
+                self.log.info(recursion_level * "\t" +
+                              "Applying substitution %s in %s invocation" % (
+                                  str(substitution),
+                                  "[" + "->".join(outer_templates) + ("->" if outer_templates else "") +
+                                  template_name + "]"
+                              ))
+                nested = set()
+                start = time.perf_counter()
+                expanded = tuple(self._expand(self.lexer.tokenize(template.interpolate_values(values)),
+                                              outer_templates + [template_name], recursion_level + 1, nested))
+                if self._profile_hooks:
+                    self._profiled(LabGen.STAGE_EXPAND_TEMPLATE, template_name, time.perf_counter() - start)
+                self._expansions[(template_name, values)] = expansion = (expanded, frozenset(nested))
+            else:
+                self.log.debug(recursion_level * "\t" + "Reusing expansion of %s with %s" % (template_name, values))
+            expanded, nested = expansion
+            for name in nested:
+                self._use(LabGen.KIND_TEMPLATE, name)
+            if used_templates is not None:
+                used_templates.add(template_name)
+                used_templates.update(nested)
+            yield from expanded
 
     def resolve_templates(self, string):
-        return self._resolve_templates(string, [], 0)
+        return "".join(node.text if isinstance(node, TextNode) else node.raw
+                       for node in self._expand(self.lexer.tokenize(string), [], 0))
+
+    def invoke_command(self, node):
+        command = COMMAND_DEFINITIONS.get(node.name)
+        if command is None:
+            raise LabGenError("No such command: @\"%s\"" % (node.name,))
+        self._use(LabGen.KIND_COMMAND, command.name)
+        args = node.args or ""
+        if Template.INVOCATION_CHAR in args:
+            args = self.resolve_templates(args)
+        arg_dict = LabGen.parse_args(args)
+        self.log.info("invoking command %s with args %s" % (str(command), str(arg_dict)))
+        return command(self, arg_dict)
 
     def invoke_commands(self, string):
-        def interceptor_func(match):
-            command = COMMAND_DEFINITIONS.get(match.group("var"))
-            if command is None:
-                raise LabGenError("No such command: @\"%s\"" % (match.group("var"),))
-            arg_dict = LabGen.parse_args(match.group("args") or "")
-            self.log.info("invoking command %s with args %s" % (str(command), str(arg_dict)))
-            return command(self, arg_dict)
+        return "".join(self._invoke_commands(self.command_lexer.tokenize(string)))
 
-        return Command.INVOCATION_PATTERN.sub(interceptor_func, string)
+    def _invoke_commands(self, nodes):
+        for node in nodes:
+            if isinstance(node, TextNode):
+                yield node.text
+                continue
+            if not self._profile_hooks:
+                result = self.invoke_command(node)
+                # commands may produce their output in chunks
+                if isinstance(result, str):
+                    yield result
+                else:
+                    yield from result
+                continue
+            start = time.perf_counter()
+            result = self.invoke_command(node)
+            elapsed = time.perf_counter() - start
+            if isinstance(result, str):
+                self._profiled(LabGen.STAGE_INVOKE_COMMAND, node.name, elapsed)
+                yield result
+            else:
+                yield from self._timed_chunks(LabGen.STAGE_INVOKE_COMMAND, node.name, result, elapsed)
+
+    def _timed_chunks(self, stage, name, chunks, elapsed=0.0):
+        """
+        Yields chunks, reporting time spent producing them (not consuming) once they are exhausted
+        """
+        iterator = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            chunk = next(iterator, None)
+            elapsed += time.perf_counter() - start
+            if chunk is None:
+                break
+            yield chunk
+        self._profiled(stage, name, elapsed)
+
+    def render_iter(self, string):
+        """
+        Expands templates and invokes commands in one walk over the document, yielding output chunks
+        """
+        self._log_stage("RENDER")
+        return self._invoke_commands(self._expand(self.lexer.tokenize(string), [], 0))
 
     def render(self, string):
-        self._log_stage("RENDER STAGE 1: RESOLVE TEMPLATES")
-        string = self.resolve_templates(string)
-        self._log_stage("RENDER STAGE 2: INVOKE COMMANDS")
-        return self.invoke_commands(string)
+        return "".join(self.render_iter(string))
 
     def parse_templates(self, string):
-        for match in Template.DEFINITION_PATTERN.finditer(string):
-            template_name = match.group("name")
-            self.templates[template_name] = t = Template(template_name, match.group("info"))
-            self.log.info("Defined template \"%s\"" % (str(t),))
+        """
+        Returns list of defined entities
+        """
+        return self._merge_header(HeaderFile.parse_templates(string))
+
+    def parse_data(self, string, base_dir=None):
+        """
+        Returns list of defined entities
+
+        :param base_dir: directory against which relative table sources are resolved
+        """
+        return self._merge_header(HeaderFile.parse_data(string, base_dir=base_dir, body_cache=self.table_cache))
+
+    def _merge_header(self, header, conflicts=None):
+        """
+        Puts everything defined in header into this instance. Names which are already defined are not
+        redefined; they are either appended to conflicts list, or reported with LabGenError if it is None.
+        Returns list of defined entities
+        """
+        defined, found_conflicts = [], []
+        for kind, pool, items in ((LabGen.KIND_TEMPLATE, self.templates, header.templates),
+                                  (LabGen.KIND_TABLE, self.tables, header.tables),
+                                  (LabGen.KIND_PLOT, self.plots, header.plots)):
+            for item in items:
+                if item.name in pool:
+                    found_conflicts.append("%s %s is defined in %s and again in %s" % (
+                        kind, item.name, self.dependencies.defined_by.get((kind, item.name), "<string>"),
+                        header.path or "<string>"))
+                    continue
+                if kind == LabGen.KIND_TABLE and item.name in self.constants:
+                    found_conflicts.append("table %s is also a constant in %s" % (
+                        item.name, self.constants[item.name].name))
+                    continue
+                if isinstance(item, DerivedTable):
+                    clashing = [name for name in item.expressions if name in self.constants or name in self.tables]
+                    if clashing:
+                        found_conflicts.append("constants %s of %s are already defined" % (
+                            ", ".join(clashing), item.name))
+                        continue
+                    item.labgen_instance = self
+                    self.constants.update(dict.fromkeys(item.expressions, item))
+                if kind == LabGen.KIND_TABLE:
+                    item.table_pool, item.body_cache = self.tables, self.table_cache
+                elif kind == LabGen.KIND_PLOT:
+                    item.labgen_instance = self
+                pool[item.name] = item
+                defined.append((kind, item.name))
+                self.log.info("Defined %s %s" % (kind, item))
+        if any(kind == LabGen.KIND_TEMPLATE for kind, _ in defined):
+            self._expansions.clear()
+        if any(kind == LabGen.KIND_TABLE for kind, _ in defined):
+            self.data_version += 1
+        if found_conflicts:
+            if conflicts is None:
+                raise LabGenError("Conflicting definitions: " + "; ".join(found_conflicts))
+            conflicts.extend(found_conflicts)
+        return defined
+
+    def _remove_definitions(self, path):
+        removed = self.dependencies.pop_definitions(path)
+        for kind, name in removed:
+            item = {LabGen.KIND_TEMPLATE: self.templates,
+                    LabGen.KIND_TABLE: self.tables,
+                    LabGen.KIND_PLOT: self.plots}[kind].pop(name, None)
+            if isinstance(item, DerivedTable):
+                for constant in item.expressions:
+                    self.constants.pop(constant, None)
+        if any(kind == LabGen.KIND_TEMPLATE for kind, _ in removed):
+            self._expansions.clear()
+        if any(kind == LabGen.KIND_TABLE for kind, _ in removed):
+            self.data_version += 1
+        return removed
+
+    def _apply_header(self, path, header, conflicts=None):
+        """
+        Replaces everything previously defined by header file at path by contents of header.
+        Names which are defined elsewhere already are skipped; they are appended to conflicts list, or reported
+        with LabGenError once everything else is defined, if it is None.
+        Returns set of entities which were added, removed or whose definitions changed
+        """
+        old = self._remove_definitions(path)
+        new, found_conflicts = {}, []
+        if header is not None:
+            new = {entity: header.digests.get(entity) for entity in self._merge_header(header, found_conflicts)}
+            # merged entities must belong to the file even if there are conflicts, so they can be redefined later
+            self.dependencies.set_definitions(path, new)
+        if found_conflicts:
+            if conflicts is None:
+                raise LabGenError("Conflicting definitions: " + "; ".join(found_conflicts))
+            conflicts.extend(found_conflicts)
+        return {entity for entity in old.keys() | new.keys()
+                if old.get(entity) is None or old[entity] != new.get(entity)}
+
+    def table_dependencies(self, name):
+        """
+        Returns names of tables which table is built from: stacked tables, or tables and constant blocks used
+        by a constant block. Other identifiers of constant expressions may be among them
+        """
+        table = self.tables[name]
+        names = set(table.stacked_tables())
+        if isinstance(table, DerivedTable):
+            for identifier in set().union(*map(find_identifiers, table.expressions.values())):
+                block = self.constants.get(identifier)
+                names.add(block.name if block is not None else identifier)
+        return names
+
+    def dependent_entities(self, entities):
+        """
+        Returns entities along with meta tables, constant blocks and plots which use them, directly or not
+        """
+        tables = {name for kind, name in entities if kind == LabGen.KIND_TABLE}
+        while True:
+            found = {name for name in self.tables if name not in tables and self.table_dependencies(name) & tables}
+            if not found:
+                break
+            tables |= found
+        names = tables | {name for name, block in self.constants.items() if block.name in tables}
+        return set(entities) | {(LabGen.KIND_TABLE, name) for name in tables} | \
+            {(LabGen.KIND_PLOT, name) for name, plot in self.plots.items() if plot.identifiers() & names}
+
+    def used_tables(self, entities):
+        """
+        Returns names of tables among entities and of tables they are built from, directly or not
+        """
+        names = [name for kind, name in entities if kind == LabGen.KIND_TABLE]
+        used = set()
+        while names:
+            name = names.pop()
+            if name not in used and name in self.tables:
+                used.add(name)
+                names.extend(self.table_dependencies(name))
+        return used
 
-    def parse_data(self, string):
-        # we do this in 3 stages
-        # 1. parse all tables
-        for match in Table.DEFINITION_PATTERN.finditer(string):
-            name, hr_name, metadata, body = match.group("name"), \
-                                            match.group("caption"), \
-                                            match.group("metadata"), \
-                                            match.group("body")
-            new_table = Table(name, hr_name, metadata.strip(), body.strip())
-            self.tables[name] = new_table
-            self.log.info("Created new table variable %s" % (new_table,))
-        # process meta-tables and so
-        for table in self.tables.values():
-            table.process_meta_properties(self.tables)
-        # 2. parse all constants
-        pass
-        # 3. parse all plots
-        for match in Plot.DEFINITION_PATTERN.finditer(string):
-            name, hr_name, metadata = match.group("name"), match.group("caption"), match.group("info")
-            self.plots[name] = Plot(name, hr_name, metadata, self)
-            self.log.info("Created new plot variable %s" % (self.plots[name],))
+    @staticmethod
+    def data_file_state(path):
+        """
+        Returns (size, mtime_ns) of data file, or (None, None) if it is missing
+        """
+        try:
+            st = os.stat(path)
+            return st.st_size, st.st_mtime_ns
+        except OSError:
+            return None, None
+
+    def data_states(self, entities):
+        """
+        Returns sorted tuple of (path, size, mtime_ns) of external data files of used tables and tables
+        they are built from. Size and mtime of missing files are None
+        """
+        paths = {self.tables[name].source_path for name in self.used_tables(entities)} - {""}
+        return tuple((path,) + LabGen.data_file_state(path) for path in sorted(paths))
+
+    def refresh_data_files(self):
+        """
+        Drops bodies of tables whose external data files changed since the previous check, and of tables built
+        from them. Returns set of these tables as entities
+        """
+        states = {table.source_path: None for table in self.tables.values() if table.source_path}
+        for path in states:
+            states[path] = LabGen.data_file_state(path)
+        changed = {path for path, state in states.items() if self._data_file_states.get(path, state) != state}
+        self._data_file_states = states
+        for path in sorted(changed):
+            self._log_stage("Data file changed: %s" % (path,))
+        entities = self.dependent_entities({(LabGen.KIND_TABLE, name) for name, table in self.tables.items()
+                                            if table.source_path in changed})
+        for kind, name in entities:
+            table = self.tables.get(name) if kind == LabGen.KIND_TABLE else None
+            if table is not None and table.reloadable():
+                table.body = None
+        if entities:
+            self.data_version += 1
+        return {(kind, name) for kind, name in entities if kind == LabGen.KIND_TABLE}
+
+    def process_header_file(self, path, encoding="utf-8", conflicts=None):
+        """
+        Parses single header file, replacing everything previously defined by it.
+        Returns set of entities which were added, removed or whose definitions changed
+
+        :param conflicts: list for conflicting definitions; if None, they are reported with LabGenError
+        """
+        path = os.path.normpath(path)
+        if not os.path.exists(path):
+            self._header_states.pop(path, None)
+            return self._apply_header(path, None, conflicts)
+        st = os.stat(path)
+        self._header_states[path] = (st.st_size, st.st_mtime_ns)
+        text = read_file(path, encoding)
+        header = self.snapshot.fetch(path, text) if self.snapshot is not None else None
+        if header is None:
+            self.log.info("Parsing header file %s" % (path,))
+            with self.profile(LabGen.STAGE_PARSE_HEADER, path):
+                header = HeaderFile.parse(path, text, self.table_cache)
+            if self.snapshot is not None:
+                self.snapshot.store(path, text, header)
+        return self._apply_header(path, header, conflicts)
+
+    def discover(self, names, extensions, recursive=False):
+        """
+        Returns sorted list of (path, size, mtime_ns) of files with given extensions in names (files or directories),
+        filtered by include and exclude patterns
+        """
+        found = {}
+        for name in names or ():
+            if not os.path.exists(name):
+                self.log.warning("No such file or directory: %s" % (name,))
+            for path, size, mtime in scan_files(name, recursive, extensions, self.include, self.exclude):
+                found[path] = (size, mtime)
+        return [(path, size, mtime) for path, (size, mtime) in sorted(found.items())]
+
+    def _process_pool(self):
+        if self._process_executor is None:
+            self._process_executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        return self._process_executor
+
+    def _thread_pool(self):
+        # single thread: matplotlib is not meant to draw concurrently in one process
+        if self._thread_executor is None:
+            self._thread_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._thread_executor
+
+    def _shutdown_pools(self):
+        for executor in (self._process_executor, self._thread_executor):
+            if executor is not None:
+                executor.shutdown()
+        self._process_executor, self._thread_executor = None, None
 
     def process_files(self, filenames, recursive=False, encoding="utf-8"):
-        def action(filename, ext, string):
-            nonlocal self
-            self.log.debug("Looking at: " + filename + "." + ext)
-            if ext == LabGen.DATA_FILE_FORMAT:
-                self.log.info("Parsing datafile %s.%s" % (filename, ext))
-                self.parse_data(string)
-            elif ext == LabGen.TEMPLATE_FILE_FORMAT:
-                self.log.info("Parsing template file %s.%s" % (filename, ext))
-                self.parse_templates(string)
-        for name in filenames:
-            do_for_path(name, action, recursive=recursive, encoding=encoding)
+        """
+        Parses header files, reusing snapshot entries for files which did not change.
+        With more than one job, files are read by a thread pool and parsed by a process pool;
+        results are merged in order of paths anyway.
+        Raises LabGenError listing all conflicting definitions, if there are some
+        """
+        files = self.discover(filenames, (LabGen.DATA_FILE_FORMAT, LabGen.TEMPLATE_FILE_FORMAT), recursive)
+        paths = [path for path, _, _ in files]
+        stats = {path: (size, mtime) for path, size, mtime in files}
+        self._header_states.update(stats)
+        headers = {}
+        if self.snapshot is not None:
+            for path in paths:
+                header = self.snapshot.fetch(path, stat=stats[path])
+                if header is not None:
+                    headers[path] = header
+        stale = [path for path in paths if path not in headers]
+        parallel = self.jobs > 1 and len(stale) > 1
+        with self.profile(LabGen.STAGE_READ_HEADERS, "%d files" % (len(stale),)):
+            if parallel:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as io_executor:
+                    texts = dict(zip(stale, io_executor.map(lambda p: read_file(p, encoding), stale)))
+            else:
+                texts = {path: read_file(path, encoding) for path in stale}
+        if self.snapshot is not None:
+            for path in stale:
+                header = self.snapshot.fetch(path, texts[path])
+                if header is not None:
+                    headers[path] = header
+        stale = [path for path in stale if path not in headers]
+        if stale:
+            self._log_stage("Parsing %d of %d header files with %d job(s)" % (len(stale), len(paths), self.jobs))
+        if parallel and len(stale) > 1:
+            parsed = self._process_pool().map(HeaderFile.parse_timed, stale, [texts[path] for path in stale],
+                                              chunksize=max(1, len(stale) // (4 * self.jobs)))
+        else:
+            parsed = (HeaderFile.parse_timed(path, texts[path]) for path in stale)
+        for path, (header, seconds) in zip(stale, parsed):
+            self._profiled(LabGen.STAGE_PARSE_HEADER, path, seconds)
+            headers[path] = header
+            if self.snapshot is not None:
+                self.snapshot.store(path, texts[path], header)
+        conflicts = []
+        for path in paths:
+            self._apply_header(path, headers[path], conflicts)
+        if self.snapshot is not None:
+            self.snapshot.save()
+            self._log_stage(self.snapshot.stats())
+        if conflicts:
+            raise LabGenError("Conflicting definitions: " + "; ".join(conflicts))
+        self.resolve_meta_tables()
+        self.refresh_data_files()
+
+    def resolve_meta_tables(self):
+        """
+        Checks that meta tables stack only existing tables and have no cycles.
+        Returns meta table names in order they can be stacked; no table data is touched
+        """
+        def dependencies(name):
+            table = self.tables.get(name)
+            if table is None:
+                raise LabGenError("meta table stacks unknown table %s" % (name,))
+            return table.stacked_tables()
+
+        with self.profile(LabGen.STAGE_RESOLVE_META_TABLES):
+            meta = [name for name, table in self.tables.items() if table.stacked_tables()]
+            order = [name for name in topological_order(meta, dependencies) if self.tables[name].stacked_tables()]
+        if order:
+            self.log.info("Meta tables resolution order: %s" % (", ".join(order),))
+        return order
+
+    def render_environment(self):
+        """
+        Key of everything besides the source itself which output depends on: header files, available figures
+        and image targets. Data files of tables are checked per source, see data_states
+        """
+        # images of plots appear after first run, they are covered by header states anyway
+        plot_figures = tuple(plot.figure_name for plot in self.plots.values())
+        figures = sorted(name for name in self.figures if not name.startswith(plot_figures))
+        digest = hashlib.sha1(repr((sorted(self._header_states.items()), figures,
+                                    self.figure_formats, self.output_dir, self.figures_dir)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def source_unchanged(self, path, stat):
+        """
+        Checks if source can be skipped (see skip_unchanged); restores its usages if so
+        """
+        if not self.skip_unchanged or self.source_index is None:
+            return False
+        usages = self.source_index.fetch(path, stat, self.render_environment(), self.data_states)
+        if usages is None or not os.path.exists(self._output_path(os.path.basename(split_ext(path)[0]))):
+            return False
+        # images of used plots are not part of render environment, but they must exist
+        for kind, name in usages:
+            plot = self.plots.get(name) if kind == LabGen.KIND_PLOT else None
+            if plot is not None and not all(os.path.exists(plot.target_path(target)) for target in plot.targets()):
+                return False
+        self.log.info("Source unchanged, skipped: %s" % (path,))
+        self.dependencies.set_usages(path, usages)
+        return True
+
+    def _source_rendered(self, path, stat, written, usages):
+        if self.source_index is None:
+            return
+        if written:
+            self.source_index.store(path, stat, self.render_environment(), usages, self.data_states(usages))
+        else:
+            self.source_index.discard(path)
+
+    def render_file(self, path, encoding="utf-8", stat=None):
+        """
+        Returns False if output file could not be written
+
+        :param stat: (size, mtime_ns) of source, if known already
+        """
+        path = os.path.normpath(path)
+        filename, ext = split_ext(path)
+        if ext != LabGen.SOURCE_FILE_FORMAT:
+            return True
+        if stat is None:
+            st = os.stat(path)
+            stat = (st.st_size, st.st_mtime_ns)
+        if self.source_unchanged(path, stat):
+            return True
+        self.log.info("Processing file %s" % (path,))
+        self._usages = set()
+        written = False
+        try:
+            with self.profile(LabGen.STAGE_RENDER_SOURCE, path):
+                written = self._write_out_file(os.path.basename(filename),
+                                               self.render_iter(read_file(path, encoding)), encoding)
+            return written
+        finally:
+            self.dependencies.set_usages(path, self._usages)
+            self._source_rendered(path, stat, written, self._usages)
+            self._usages = None
 
     def render_files(self, filenames, encoding="utf-8"):
-        def action(filename, ext, string):
-            nonlocal self
-            if ext != LabGen.SOURCE_FILE_FORMAT:
-                return
-            self.log.info("Processing file %s.%s" % (filename, ext))
-            self._write_out_file(
-                os.path.basename(filename),
-                self.render(string),
-                encoding
-            )
-        for path in filenames:
-            do_for_path(path, action, recursive=False, encoding=encoding)
+        for path, size, mtime in self.discover(filenames, (LabGen.SOURCE_FILE_FORMAT,)):
+            self.render_file(path, encoding, (size, mtime))
+        self.join_images()
+
+    def render_batch(self, filenames, encoding="utf-8", table_bytes=None):
+        """
+        Renders many sources against headers parsed once. A failing source does not stop the others.
+        With more than one job and fork available, sources are rendered by worker processes which inherit
+        this instance, with tables loaded beforehand so their arrays are shared rather than re-parsed.
+        These are tables which sources used when they were rendered last time (in this instance or, according
+        to source index, in a previous run); all tables are loaded if that is unknown for some source.
+        Returns list of (path, error message or None) in order of paths
+
+        :param table_bytes: memory limit of a long-running instance (see trim_memory); if given, only tables known
+            to be used are loaded beforehand, others are loaded by workers which need them
+        """
+        global _batch_instance
+        results, paths, stats = [], [], {}
+        for path, size, mtime in self.discover(filenames, (LabGen.SOURCE_FILE_FORMAT,)):
+            stats[path] = (size, mtime)
+            if self.source_unchanged(path, stats[path]):
+                results.append((path, None))
+            else:
+                paths.append(path)
+        if self.jobs > 1 and len(paths) > 1 and "fork" in multiprocessing.get_all_start_methods():
+            self.join_images()
+            self._shutdown_pools()
+            used, preload_all = set(), False
+            for path in paths:
+                usages = self.dependencies.usages.get(path)
+                if usages is None and self.source_index is not None:
+                    usages = self.source_index.usages(path)
+                if usages is None:
+                    preload_all = table_bytes is None
+                else:
+                    used |= usages
+            for name in sorted(self.tables if preload_all else self.used_tables(used)):
+                try:
+                    self.get_table(name).body
+                except LabGenError as e:
+                    # reports using this table will fail on their own
+                    self.log.info("Table %s is not loaded before batch: %s" % (name, e))
+            self._log_stage("Rendering %d sources with %d worker processes" % (len(paths), self.jobs))
+            _batch_instance = self
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                                                            mp_context=multiprocessing.get_context("fork"),
+                                                            initializer=_init_batch_worker) as executor:
+                    futures = [executor.submit(_render_batch_item, path, encoding) for path in paths]
+                    for path, future in zip(paths, futures):
+                        try:
+                            error, usages, events = future.result()
+                        except Exception as e:  # e.g. worker was killed
+                            error, usages, events = "%s: %s" % (e.__class__.__name__, e), set(), []
+                        for event in events:
+                            self._profiled(*event)
+                        self.dependencies.set_usages(path, usages)
+                        self._source_rendered(path, stats[path], error is None, usages)
+                        results.append((path, error))
+            finally:
+                _batch_instance = None
+        else:
+            for path in paths:
+                error = None
+                try:
+                    if not self.render_file(path, encoding, stats[path]):
+                        error = "output file was not written"
+                    self.join_images()
+                except Exception as e:
+                    error = "%s: %s" % (e.__class__.__name__, e)
+                results.append((path, error))
+        failed = [(path, error) for path, error in results if error is not None]
+        self._log_stage("Batch finished: %d of %d sources rendered" % (len(results) - len(failed), len(results)))
+        for path, error in failed:
+            self.log.error("Failed to render %s: %s" % (path, error))
+        return results
+
+    def refresh_headers(self, headers, recursive=False, encoding="utf-8"):
+        """
+        Re-parses header files which changed, appeared or disappeared since they were processed,
+        and drops tables whose external data files changed (see refresh_data_files).
+        Returns set of entities which were added, removed or changed, along with entities which depend on them
+        """
+        states = {path: (size, mtime) for path, size, mtime in
+                  self.discover(headers, (LabGen.DATA_FILE_FORMAT, LabGen.TEMPLATE_FILE_FORMAT), recursive)}
+        changed = set()
+        for path in sorted(states.keys() | self._header_states.keys()):
+            if states.get(path) != self._header_states.get(path):
+                self._log_stage("Header changed: %s" % (path,))
+                conflicts = []
+                try:
+                    changed |= self.process_header_file(path, encoding, conflicts)
+                except LabGenError as e:
+                    self._log_stage("Failed to process %s" % (path,), exception=e)
+                if conflicts:
+                    self._log_stage("Conflicting definitions in %s" % (path,), exception="; ".join(conflicts))
+        changed |= self.refresh_data_files()
+        if changed:
+            try:
+                self.resolve_meta_tables()
+            except LabGenError as e:
+                self._log_stage("Invalid meta tables", exception=e)
+            for plot in self.plots.values():
+                plot.figures.clear()
+            changed = self.dependent_entities(changed)
+        return changed
+
+    def trim_memory(self, table_bytes=None):
+        """
+        Bounds memory of a long-running instance: forgets template expansions over MAX_EXPANSIONS and,
+        if loaded table bodies take more than table_bytes, memoized expression results and then least recently
+        used tables (see Table.unload; without cache, inline tables stay loaded). Evicts figure and table caches
+        according to their limits.
+        Returns count of unloaded tables
+        """
+        if len(self._expansions) > LabGen.MAX_EXPANSIONS:
+            self._expansions.clear()
+        unloaded = 0
+        if table_bytes is not None:
+            loaded = sorted((self._table_uses.get(name, -1), name) for name, table in self.tables.items()
+                            if table.materialized)
+            total = sum(self.tables[name].body_size() for _, name in loaded)
+            if total > table_bytes:
+                self._constant_values, self._constants_version = {}, None
+                self.expressions.scopes.clear()
+            for _, name in loaded:
+                if total <= table_bytes:
+                    break
+                released = self.tables[name].unload()
+                if released or not self.tables[name].materialized:
+                    total -= released
+                    unloaded += 1
+            self._table_uses = {name: tick for name, tick in self._table_uses.items() if name in self.tables}
+        if self.figure_cache is not None:
+            self.figure_cache.evict()
+        if self.table_cache is not None:
+            self.table_cache.evict()
+        return unloaded
+
+    def watch(self, headers, sources, interval=1.0, recursive=False, encoding="utf-8"):
+        """
+        Re-parses changed header files and re-renders affected sources until interrupted.
+        Sources are expected to be rendered once before this is called
+        """
+        def snapshot(paths):
+            return {path: (size, mtime) for path, size, mtime in
+                    self.discover(paths, (LabGen.SOURCE_FILE_FORMAT,))}
+
+        source_states = snapshot(sources)
+        self._log_stage("WATCHING FOR CHANGES")
+        try:
+            while True:
+                time.sleep(interval)
+                changed = self.refresh_headers(headers, recursive, encoding)
+                new_source_states = snapshot(sources)
+                to_render = set(self.dependencies.affected_sources(changed))
+                to_render |= {path for path in new_source_states
+                              if new_source_states[path] != source_states.get(path)}
+                source_states = new_source_states
+                for path in sorted(to_render):
+                    try:
+                        self.render_file(path, encoding)
+                    except Exception as e:  # e.g. command invoked without required args
+                        self._log_stage("Failed to render %s" % (path,),
+                                        exception="%s: %s" % (e.__class__.__name__, e))
+                try:
+                    self.join_images()
+                except LabGenError as e:
+                    self._log_stage("Failed to produce images", exception=e)
+        except KeyboardInterrupt:
+            self._log_stage("WATCH STOPPED")
 
     def _prepare_logger(self, level):
         handler = logging.StreamHandler(sys.stdout)
@@ -770,19 +3293,40 @@ class LabGen:
         log.setLevel(level)
         return log
 
-    def _write_out_file(self, filename, contents, encoding="utf-8"):
-        path = self.output_dir + os.sep + filename + (
+    def _output_path(self, filename):
+        return self.output_dir + os.sep + filename + (
             (os.extsep + LabGen.OUTPUT_FILE_FORMAT) if split_ext(filename)[1] != LabGen.OUTPUT_FILE_FORMAT else
             ""
         )
+
+    def _write_out_file(self, filename, contents, encoding="utf-8"):
+        """
+        :param contents: string or iterable of strings. Output goes to a temporary file first,
+            so a failed render does not leave a truncated output behind. Existing file with the same contents
+            is not replaced, so its mtime does not change
+        """
+        path = self._output_path(filename)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
         self._log_stage("Writing output file %s" % (path,))
         try:
-            with open(path, "w", encoding=encoding) as file:
-                file.write(contents)
-        except Exception as e:
+            with open(tmp_path, "w", encoding=encoding, buffering=LabGen.OUTPUT_BUFFER_SIZE) as file:
+                if isinstance(contents, str):
+                    file.write(contents)
+                else:
+                    for chunk in contents:
+                        file.write(chunk)
+            unchanged = os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False)
+            if not unchanged:
+                os.replace(tmp_path, path)
+        except OSError as e:
             self._log_stage("Failed to write file %s" % (path,), exception=e)
+            return False
         else:
-            self._log_stage("File written %s" % (path,))
+            self._log_stage(("File unchanged %s" if unchanged else "File written %s") % (path,))
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     def _load_figures(self):
         for file in os.listdir(self.figures_dir):
@@ -800,6 +3344,133 @@ class LabGen:
             self.log.info("===== REASON: " + str(exception))
 
 
+class RenderServer:
+    """
+    Keeps a LabGen instance with parsed headers and warm plotting backend resident behind a localhost HTTP endpoint.
+    Requests and responses are JSON:
+
+        POST /render {"sources": ["/path/report.lgs", ...]}
+            -> {"results": [{"source": ..., "output": ..., "error": null}, ...], "seconds": ...}
+        GET /status -> counts of definitions, loaded tables and their memory
+        POST /shutdown
+
+    Before each render, changed header files are parsed again; after it, memory is trimmed (see LabGen.trim_memory).
+    Requests are handled one at a time
+    """
+    DEFAULT_HOST = "127.0.0.1"
+    DEFAULT_PORT = 8765
+
+    def __init__(self, labgen, headers, recursive=False, encoding="utf-8", table_bytes=None):
+        """
+        :param headers: header files and directories to watch for changes
+        :param table_bytes: memory limit of loaded table bodies, or None for no limit
+        """
+        self.labgen = labgen
+        self.headers = headers
+        self.recursive = recursive
+        self.encoding = encoding
+        self.table_bytes = table_bytes
+        self.running = False
+        self.requests = 0
+
+    def warm_up(self):
+        import_figure_class()
+        self.labgen.expressions.interpreter
+
+    def render(self, request):
+        sources = request.get("sources")
+        if not isinstance(sources, list) or not all(isinstance(source, str) for source in sources):
+            raise LabGenError("sources must be a list of paths")
+        lg = self.labgen
+        start = time.perf_counter()
+        lg.refresh_headers(self.headers, self.recursive, self.encoding)
+        missing = [source for source in sources if not os.path.isfile(source)]
+        results = lg.render_batch([source for source in sources if source not in missing],
+                                  request.get("encoding", self.encoding), self.table_bytes)
+        results.extend((source, "no such file") for source in missing)
+        unloaded = lg.trim_memory(self.table_bytes)
+        if unloaded:
+            lg.log.info("Unloaded %d table(s)" % (unloaded,))
+        return {
+            "results": [{"source": path, "error": error,
+                         "output": None if error else
+                         os.path.abspath(lg._output_path(os.path.basename(split_ext(path)[0])))}
+                        for path, error in results],
+            "seconds": time.perf_counter() - start,
+        }
+
+    def status(self):
+        lg = self.labgen
+        return {
+            "templates": len(lg.templates), "tables": len(lg.tables), "plots": len(lg.plots),
+            "constants": len(lg.constants),
+            "loaded_tables": sum(table.materialized for table in lg.tables.values()),
+            "table_bytes": sum(table.body_size() for table in lg.tables.values()),
+            "requests": self.requests,
+        }
+
+    def handle(self, method, path, body):
+        """
+        Returns HTTP status and JSON-serializable response
+        """
+        if (method, path) == ("GET", "/status"):
+            return 200, self.status()
+        if (method, path) == ("POST", "/shutdown"):
+            self.running = False
+            return 200, {"stopping": True}
+        if (method, path) != ("POST", "/render"):
+            return 404, {"error": "unknown request %s %s" % (method, path)}
+        try:
+            request = json.loads(body.decode("utf-8") or "{}")
+        except ValueError as e:
+            return 400, {"error": "invalid JSON: %s" % (e,)}
+        if not isinstance(request, dict):
+            return 400, {"error": "request must be a JSON object"}
+        try:
+            return 200, self.render(request)
+        except LabGenError as e:
+            return 400, {"error": str(e)}
+
+    def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        import http.server
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def respond(self, method):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, response = server.handle(method, self.path, body)
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                server.requests += 1
+
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def log_message(self, format, *args):
+                server.labgen.log.info("%s %s" % (self.address_string(), format % args))
+
+        self.warm_up()
+        httpd = http.server.HTTPServer((host, port), Handler)
+        httpd.timeout = 1.0
+        self.running = True
+        self.labgen._log_stage("SERVING on http://%s:%d" % httpd.server_address[:2])
+        try:
+            while self.running:
+                httpd.handle_request()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            self.labgen._log_stage("SERVER STOPPED")
+
+
 def prepare_command_line_args_parser():
     parser = argparse.ArgumentParser(description="LabGen")
 
@@ -810,13 +3481,73 @@ def prepare_command_line_args_parser():
                                                            (LabGen.DATA_FILE_FORMAT, LabGen.TEMPLATE_FILE_FORMAT))
     parser.add_argument("-S", "--source", nargs="*", help="source files and/or dirs with .%s files" %
                                                           (LabGen.SOURCE_FILE_FORMAT,))
+    parser.add_argument("--include", nargs="*", default=[], metavar="GLOB",
+                        help="process only header and source files matching one of these patterns")
+    parser.add_argument("--exclude", nargs="*", default=[], metavar="GLOB",
+                        help="ignore header and source files and directories matching these patterns")
+    parser.add_argument("--skip-unchanged", action="store_true",
+                        help="do not render sources which did not change since last run, if headers, figures and "
+                             "image formats did not change either; note that e.g. @date is not refreshed then")
+    parser.add_argument("--figure-formats", nargs="*", default=[Plot.IMAGE_FORMAT],
+                        help="image targets of plots, like png png@300 pdf; the first one goes into documents. "
+                             "Plot property formats=png;pdf overrides this")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes used to draw plots")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="keep running, re-rendering sources affected by changes in headers and sources")
+    parser.add_argument("-b", "--batch", action="store_true",
+                        help="render each source independently, in parallel with --jobs; "
+                             "a failing source does not stop the others")
+    parser.add_argument("--profile", metavar="OUT_JSON",
+                        help="collect timings of stages, write them to this file and log the slowest entries")
+    parser.add_argument("--profile-top", type=int, default=10, help="count of slowest entries per stage to log")
+    parser.add_argument("--serve", nargs="?", type=int, const=RenderServer.DEFAULT_PORT, metavar="PORT",
+                        help="keep parsed headers in memory and render sources on requests to "
+                             "http://127.0.0.1:PORT/render (default port %d)" % (RenderServer.DEFAULT_PORT,))
+    parser.add_argument("--serve-host", default=RenderServer.DEFAULT_HOST, help="address to serve on")
+    parser.add_argument("--table-memory", type=float, help="max memory of loaded table bodies when serving, MiB")
+    parser.add_argument("--watch-interval", type=float, default=1.0, help="seconds between checks for changes")
+    parser.add_argument("--cache-dir", help="directory for persistent caches (default: <output dir>/%s)" %
+                                            (LabGen.DEFAULT_CACHE_DIR,))
+    parser.add_argument("--no-cache", action="store_true", help="do not use persistent caches")
+    parser.add_argument("--cache-max-size", type=float, help="max size of figure cache, MiB")
+    parser.add_argument("--cache-max-age", type=float, help="max days since figure or table cache entry was last used")
+    parser.add_argument("--table-cache-max-size", type=float, help="max size of parsed table cache, MiB")
     return parser
 
 
 if __name__ == '__main__':
     namespace = prepare_command_line_args_parser().parse_args(args=sys.argv[1:])
 
-    lg = LabGen(namespace.output_dir, namespace.figures_dir)
-    lg.process_files(namespace.headers)
-
-    lg.render_files(namespace.source)
+    lg = LabGen(namespace.output_dir, namespace.figures_dir, jobs=namespace.jobs,
+                figure_formats=namespace.figure_formats,
+                include=namespace.include, exclude=namespace.exclude, skip_unchanged=namespace.skip_unchanged,
+                cache_dir=namespace.cache_dir, use_cache=not namespace.no_cache,
+                cache_max_size=None if namespace.cache_max_size is None else int(namespace.cache_max_size * 2 ** 20),
+                cache_max_age=None if namespace.cache_max_age is None else namespace.cache_max_age * 24 * 3600,
+                table_cache_max_size=None if namespace.table_cache_max_size is None else
+                int(namespace.table_cache_max_size * 2 ** 20))
+    profiler = None
+    if namespace.profile:
+        profiler = Profiler()
+        lg.add_profile_hook(profiler)
+    failed = 0
+    try:
+        lg.process_files(namespace.headers)
+
+        if namespace.batch:
+            failed = sum(error is not None for _, error in lg.render_batch(namespace.source))
+        else:
+            lg.render_files(namespace.source)
+        if namespace.watch:
+            lg.watch(namespace.headers, namespace.source, interval=namespace.watch_interval)
+        if namespace.serve is not None:
+            RenderServer(lg, namespace.headers, table_bytes=None if namespace.table_memory is None else
+                         int(namespace.table_memory * 2 ** 20)).serve(namespace.serve_host, namespace.serve)
+    finally:
+        lg.close()
+        if profiler is not None:
+            profiler.dump(namespace.profile)
+            lg._log_stage("PROFILE written to %s" % (namespace.profile,))
+            for line in profiler.summary(namespace.profile_top):
+                lg.log.info(line)
+    sys.exit(1 if failed else 0)